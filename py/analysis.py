@@ -0,0 +1,296 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""The analysis of songs into sync caches, from the configuration.
+
+Shared by synchronized_lights.py, which analyzes a song as it plays
+(see look_ahead.py), and tools/sync_file_generator.py, which analyzes
+songs ahead of time with cache_song:
+
+- the analysis settings, and the ones sync caches and light shows
+  record (a cache is rebuilt when they change)
+- the frequency band of each light channel
+- SongAnalysis, the FFT analysis plan, analysis window and beat tracker
+  of a song, giving the levels and beat columns of each hop
+- rendering the light show of a finished sync cache
+
+Third party dependencies:
+
+decoder.py: decoding mp3, ogg, wma, ...
+    https://pypi.python.org/pypi/decoder.py/1.5XB
+
+numpy: for the levels - http://www.numpy.org/
+"""
+import logging
+import os
+import wave
+
+import beat
+import configuration_manager as cm
+import decoder
+import fft
+import hardware_controller as hc
+import light_show
+import numpy as np
+import sync_cache
+
+_CONFIG = cm.CONFIG
+_MIN_FREQUENCY = _CONFIG.getfloat('audio_processing', 'min_frequency')
+_MAX_FREQUENCY = _CONFIG.getfloat('audio_processing', 'max_frequency')
+try:
+    _CUSTOM_CHANNEL_MAPPING = \
+        [int(channel) for channel in _CONFIG.get('audio_processing',\
+            'custom_channel_mapping').split(',')]
+except:
+    _CUSTOM_CHANNEL_MAPPING = 0
+try:
+    _CUSTOM_CHANNEL_FREQUENCIES = [int(channel) for channel in
+                                   _CONFIG.get('audio_processing',
+                                               'custom_channel_frequencies').split(',')]
+except:
+    _CUSTOM_CHANNEL_FREQUENCIES = 0
+try:
+    _CUSTOM_CHANNEL_BANDS = [tuple(float(frequency) for frequency in band.split('-'))
+                             for band in _CONFIG.get('audio_processing',
+                                                     'custom_channel_bands').split(',')]
+except:
+    _CUSTOM_CHANNEL_BANDS = 0
+BAND_SHAPE = _CONFIG.get('audio_processing', 'band_shape')
+ANALYSIS_DTYPE = _CONFIG.get('audio_processing', 'analysis_dtype')
+CHANNEL_MODE = _CONFIG.get('audio_processing', 'channel_mode')
+BEAT_CHANNELS = [int(channel) - 1 for channel in cm.lightshow()['beat_channels'].split(',')
+                 if channel.strip() and int(channel) > 0]
+BEAT_FLASH_LENGTH = _CONFIG.getfloat('lightshow', 'beat_flash_length')
+
+CHUNK_SIZE = _CONFIG.getint('audio_processing', 'chunk_size')
+HOP_SIZE = min(_CONFIG.getint('audio_processing', 'hop_size'), CHUNK_SIZE)
+
+# FFT backend, 'auto' times each backend the first time an analysis is
+# planned and remembers the fastest (see fft_backend)
+_FFT_BACKEND = _CONFIG.get('audio_processing', 'fft_backend')
+_FFT_TUNING_FILENAME = cm.CONFIG_DIR + '/fft_backend.json'
+
+# Hops decoded and analyzed at a time when caching a whole song
+BATCH_HOPS = 256
+
+# Analysis settings recorded in the header of each sync cache, the cache
+# is regenerated when any of them change
+CACHE_PARAMETERS = sync_cache.analysis_profile(_CONFIG)
+
+# Central directory of sync caches (None keeps each cache next to its song)
+CACHE_DIRECTORY = sync_cache.cache_directory(_CONFIG, cm.HOME_DIR)
+
+# How the levels of finished sync caches are stored, see sync_cache.ENCODINGS
+CACHE_ENCODING = _CONFIG.get('audio_processing', 'sync_cache_encoding')
+
+# Render a light show from each complete sync cache and play it instead of
+# the levels (see light_show.py)
+RENDER_SHOWS = _CONFIG.getboolean('audio_processing', 'render_light_shows')
+RENDER_PARAMETERS = light_show.render_profile(_CONFIG)
+
+# Each row of levels is followed by the onset strength and beat flag (see
+# beat.BeatTracker), in the sync cache too
+BEAT_COLUMN = hc.GPIOLEN + 1
+
+
+def calculate_channel_frequency(min_frequency, max_frequency, custom_channel_mapping,
+                                custom_channel_frequencies,
+                                custom_channel_bands=0, num_channels=0):
+    """
+    Calculate frequency values
+
+    Calculate frequency values for each channel,
+    taking into account custom settings.
+
+    num_channels is the number of light channels to calculate for,
+    defaulting to all of them.
+    """
+    gpio_length = num_channels or hc.GPIOLEN
+
+    # How many channels do we need to calculate the frequency for
+    if custom_channel_mapping != 0 and len(custom_channel_mapping) == gpio_length:
+        logging.debug("Custom Channel Mapping is being used: %s", str(custom_channel_mapping))
+        channel_length = max(custom_channel_mapping)
+    else:
+        logging.debug("Normal Channel Mapping is being used.")
+        channel_length = gpio_length
+
+    logging.debug("Calculating frequencies for %d channels.", channel_length)
+    octaves = (np.log(max_frequency / min_frequency)) / np.log(2)
+    logging.debug("octaves in selected frequency range ... %s", octaves)
+    octaves_per_channel = octaves / channel_length
+    frequency_limits = []
+    frequency_store = []
+
+    frequency_limits.append(min_frequency)
+    if custom_channel_frequencies != 0 and (len(custom_channel_frequencies) >= channel_length + 1):
+        logging.debug("Custom channel frequencies are being used")
+        frequency_limits = custom_channel_frequencies
+    else:
+        logging.debug("Custom channel frequencies are not being used")
+        for i in range(1, gpio_length + 1):
+            frequency_limits.append(frequency_limits[-1]
+                                    * 10 ** (3 / (10 * (1 / octaves_per_channel))))
+    if custom_channel_bands != 0 and len(custom_channel_bands) >= channel_length:
+        logging.debug("Custom channel bands are being used")
+        frequency_store = custom_channel_bands[:channel_length]
+    for i in range(len(frequency_store), channel_length):
+        frequency_store.append((frequency_limits[i], frequency_limits[i + 1]))
+        logging.debug("channel %d is %6.2f to %6.2f ", i, frequency_limits[i],
+                      frequency_limits[i + 1])
+
+    # we have the frequencies now lets map them if custom mapping is defined
+    if custom_channel_mapping != 0 and len(custom_channel_mapping) == gpio_length:
+        frequency_map = []
+        for i in range(0, gpio_length):
+            mapped_channel = custom_channel_mapping[i] - 1
+            mapped_frequency_set = frequency_store[mapped_channel]
+            mapped_frequency_set_low = mapped_frequency_set[0]
+            mapped_frequency_set_high = mapped_frequency_set[1]
+            logging.debug("mapped channel: " + str(mapped_channel) + " will hold LOW: "
+                          + str(mapped_frequency_set_low) + " HIGH: "
+                          + str(mapped_frequency_set_high))
+            frequency_map.append(mapped_frequency_set)
+        return frequency_map
+    else:
+        return frequency_store
+
+
+def channel_frequency_limits():
+    """
+    Calculate the frequency limits of every channel from the configuration
+
+    In the stereo and mid_side channel modes each half of the channels
+    is driven by a different audio channel, so the frequency range is
+    divided over half of the channels and both halves use the same bands.
+    """
+    if CHANNEL_MODE in ('stereo', 'mid_side'):
+        group_length = -(-hc.GPIOLEN // 2)
+    else:
+        group_length = hc.GPIOLEN
+
+    frequency_limits = calculate_channel_frequency(_MIN_FREQUENCY,
+                                                   _MAX_FREQUENCY,
+                                                   _CUSTOM_CHANNEL_MAPPING,
+                                                   _CUSTOM_CHANNEL_FREQUENCIES,
+                                                   _CUSTOM_CHANNEL_BANDS,
+                                                   group_length)
+    return (frequency_limits * 2)[:hc.GPIOLEN]
+
+
+def open_song(song_filename):
+    """Open a song for decoding"""
+    if song_filename.endswith('.wav'):
+        return wave.open(song_filename, 'r')
+    return decoder.open(song_filename)
+
+
+def fft_backend(num_channels):
+    """The FFT backend for analyzing audio with num_channels channels"""
+    return fft.select_backend(_FFT_BACKEND, CHUNK_SIZE, ANALYSIS_DTYPE,
+                              fft.source_count(CHANNEL_MODE, num_channels),
+                              tuning_filename=_FFT_TUNING_FILENAME)
+
+
+def analysis_plan(sample_rate, num_channels):
+    """The FFT analysis plan of audio with num_channels channels"""
+    return fft.AnalysisPlan(CHUNK_SIZE, sample_rate, channel_frequency_limits(), hc.GPIOLEN,
+                            num_channels, band_shape=BAND_SHAPE, dtype=ANALYSIS_DTYPE,
+                            channel_mode=CHANNEL_MODE,
+                            backend=fft_backend(num_channels))
+
+
+class SongAnalysis(object):
+    """The levels and beats of a song, a hop or a block of hops at a time
+
+    Holds the song's FFT analysis plan, the window of audio analyzed and
+    the beat tracker.  Each row of levels is the level of every light
+    channel, then the onset strength and beat flag (see BEAT_COLUMN).
+
+    Typical usage:
+
+    song = SongAnalysis(sample_rate, num_channels)
+    rows = song.levels(song.frames(musicfile.readframes(HOP_SIZE * BATCH_HOPS)))
+
+    or, a hop at a time:
+
+    song.push(musicfile.readframes(HOP_SIZE))
+    matrix = song.latest()
+    """
+
+    def __init__(self, sample_rate, num_channels):
+        self.plan = analysis_plan(sample_rate, num_channels)
+        self.ring = fft.SampleRing(CHUNK_SIZE, HOP_SIZE, num_channels)
+        self.tracker = beat.BeatTracker(HOP_SIZE, sample_rate)
+
+    def push(self, data):
+        """Add one hop of audio to the analysis window"""
+        self.ring.push(data)
+
+    def latest(self):
+        """The row of levels of the latest hop pushed"""
+        matrix = self.plan.calculate_levels(self.ring.samples())
+        return np.append(matrix, self.tracker.process(self.plan.power)[0])
+
+    def frames(self, data):
+        """The analysis window of each hop of a block of audio (see fft.SampleRing.frames)"""
+        return self.ring.frames(data)
+
+    def levels(self, frames):
+        """The rows of levels of analysis windows returned by frames"""
+        levels = self.plan.calculate_levels_batch(frames)
+        return np.hstack([levels, self.tracker.process(self.plan.power)])
+
+
+def render_show(show_filename, levels, mean, std, hop_seconds, audio):
+    """
+    Render and save the light show of a song from its complete levels
+
+    :return: the rendered show
+    :rtype: sync_cache.SyncCache
+    """
+    frames = light_show.render(levels, mean, std, hop_seconds, BEAT_CHANNELS,
+                               BEAT_FLASH_LENGTH)
+    light_show.write(show_filename, frames, RENDER_PARAMETERS, audio)
+    logging.info("Light show rendered to '" + show_filename + "' [" + str(len(frames))
+                 + " frames]")
+    return light_show.load(show_filename, RENDER_PARAMETERS, audio)
+
+
+def cache_song(song_filename):
+    """
+    Analyze a whole song and write its sync cache (and light show)
+
+    :param song_filename: the song
+    :type song_filename: str
+
+    :return: the cache file name
+    :rtype: str
+    """
+    musicfile = open_song(song_filename)
+    sample_rate = musicfile.getframerate()
+    num_channels = musicfile.getnchannels()
+
+    # create the buffer the levels are cached in, sized for the whole song
+    song_rows = sync_cache.expected_rows(musicfile.getnframes(), HOP_SIZE)
+    cache_matrix = sync_cache.LevelBuffer(BEAT_COLUMN + 1, ANALYSIS_DTYPE, song_rows)
+    cache_filename, audio = sync_cache.locate(os.path.abspath(song_filename), CACHE_DIRECTORY)
+
+    # Compute the FFT for the window ending at every hop, a block at a time
+    song = SongAnalysis(sample_rate, num_channels)
+    data = musicfile.readframes(HOP_SIZE * BATCH_HOPS)
+    while data != '':
+        cache_matrix.append(song.levels(song.frames(data)))
+        data = musicfile.readframes(HOP_SIZE * BATCH_HOPS)
+
+    # Compute the standard deviation and mean values for the cache, and save it
+    std, mean = sync_cache.statistics(cache_matrix.levels, hc.GPIOLEN)
+    sync_cache.write(cache_filename, cache_matrix.levels, std, mean, CACHE_PARAMETERS, audio,
+                     CACHE_ENCODING)
+
+    if RENDER_SHOWS:
+        render_show(light_show.show_filename(cache_filename), cache_matrix.levels, mean, std,
+                    HOP_SIZE / float(sample_rate), audio)
+    if CACHE_DIRECTORY is not None:
+        CACHE_DIRECTORY.store(cache_filename)
+    return cache_filename
@@ -0,0 +1,186 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Onset and beat tracking of audio.
+
+Finds the onsets (the start of notes and drum hits) in the music from the
+spectral flux, how much the power spectrum rises from one hop to the
+next, and follows the tempo of the onsets to flag the beats.  It works on
+the power spectrum already computed by fft.AnalysisPlan, so tracking the
+beat costs very little on top of the FFT analysis.
+
+Everything is causal (only past audio is used), so the same tracker is
+used while playing, with audio-in and when generating sync files, and
+gives the same beats in each.
+
+Third party dependencies:
+
+numpy: for the flux and tempo calculations - http://www.numpy.org/
+"""
+from numpy import log10, log2, exp, sqrt, zeros, arange, ceil, maximum, vstack, roll, \
+    correlate, argmax
+
+
+class BeatTracker(object):
+    """Spectral flux onset detector and tempo follower
+
+    Each hop of audio gets an onset strength (the spectral flux above its
+    running mean) and a beat flag.  Until a tempo has been found every
+    onset is a beat.  Once the autocorrelation of the recent onset
+    strengths gives a tempo, beats are expected one period apart: an
+    onset close to the expected time is the beat, and if none comes the
+    beat is flagged on time anyway as long as the music has onsets.
+
+    Typical usage:
+
+    tracker = BeatTracker(HOP_SIZE, sample_rate)
+    matrix = plan.calculate_levels(data)
+    onsets = tracker.process(plan.power)
+    """
+
+    def __init__(self, hop_size, sample_rate, min_bpm=60.0, max_bpm=180.0, history=8.0,
+                 threshold=1.5):
+        self.hop_seconds = hop_size / float(sample_rate)
+
+        # Running mean of the flux (0.5 seconds) and running mean / variance
+        # of the onset strength (2 seconds)
+        self._flux_smoothing = exp(-self.hop_seconds / 0.5)
+        self._strength_smoothing = exp(-self.hop_seconds / 2.0)
+        self._mean_flux = 0.0
+        self._mean_strength = 0.0
+        self._variance_strength = 0.0
+        self.threshold = threshold
+        self._above = False
+        self._previous = None
+
+        # The onset strengths used for the tempo, in a ring
+        self._history = zeros(max(int(history / self.hop_seconds), 16))
+        self._count = 0
+        self._tempo_interval = max(int(1.0 / self.hop_seconds), 1)
+
+        # Beat periods (in hops) to look for, weighted towards 120 bpm
+        self._lags = arange(max(int(60.0 / max_bpm / self.hop_seconds), 1),
+                            min(int(ceil(60.0 / min_bpm / self.hop_seconds)),
+                                len(self._history) // 2) + 1)
+        bpm = 60.0 / (self._lags * self.hop_seconds)
+        self._prior = exp(-0.5 * log2(bpm / 120.0) ** 2)
+
+        self.period = None
+        self._last_beat = -len(self._history)
+        self._last_onset = -len(self._history)
+        self._flywheel = False
+
+    @property
+    def tempo(self):
+        """Current tempo estimate in beats per minute (None until found)"""
+        if self.period is None:
+            return None
+        return 60.0 / (self.period * self.hop_seconds)
+
+    def process(self, power):
+        """Onset strength and beat flag for each hop of a power spectrum
+
+        :param power: AnalysisPlan.power, the power spectrum of one hop or
+            of a batch of hops (one hop per row)
+        :type power: numpy.array
+
+        :return: one (onset strength, beat) row per hop, beat is 1 or 0
+        :rtype: numpy.array
+        """
+        if power.ndim < 3:
+            rows = power.reshape(1, -1)
+        else:
+            rows = power.reshape(len(power), -1)
+
+        compressed = log10(1.0 + rows)
+        if self._previous is None:
+            self._previous = compressed[0]
+        rising = maximum(compressed - vstack([self._previous, compressed[:-1]]), 0)
+        flux = rising.mean(axis=1)
+        self._previous = compressed[-1]
+
+        result = zeros((len(flux), 2), dtype=power.dtype)
+        for row, value in enumerate(flux):
+            result[row] = self._step(value)
+        return result
+
+    def _step(self, flux):
+        """Onset strength and beat flag for the flux of the next hop"""
+        strength = max(0.0, flux - self._mean_flux)
+        self._mean_flux = self._flux_smoothing * self._mean_flux \
+            + (1 - self._flux_smoothing) * flux
+
+        # An onset is where the strength rises above its usual range
+        limit = self._mean_strength + self.threshold * sqrt(self._variance_strength)
+        above = strength > limit and strength > 0
+        onset = above and not self._above
+        self._above = above
+        difference = strength - self._mean_strength
+        self._mean_strength += (1 - self._strength_smoothing) * difference
+        self._variance_strength = self._strength_smoothing \
+            * (self._variance_strength + (1 - self._strength_smoothing) * difference ** 2)
+
+        self._history[self._count % len(self._history)] = strength
+        if self._count % self._tempo_interval == 0 and self._count >= len(self._history) // 2:
+            self._estimate_tempo()
+
+        hop = self._count
+        self._count += 1
+        if onset:
+            self._last_onset = hop
+        return strength, self._beat(hop, onset)
+
+    def _beat(self, hop, onset):
+        """Is there a beat at this hop"""
+        since = hop - self._last_beat
+        period = self.period
+
+        if period is None:
+            beat = onset and since >= self._lags[0]
+        elif onset and since >= 0.75 * period:
+            beat = True
+        elif onset and self._flywheel and since < 0.25 * period:
+            # the onset came just after the beat flagged on time, follow it
+            self._last_beat = hop
+            self._flywheel = False
+            return 0
+        elif since >= period and hop - self._last_onset < 4 * period:
+            # keep the beat going through a missed onset
+            self._last_beat = hop if since >= 2 * period else self._last_beat + period
+            self._flywheel = True
+            return 1
+        else:
+            beat = False
+
+        if beat:
+            self._last_beat = hop
+            self._flywheel = False
+        return 1 if beat else 0
+
+    def _estimate_tempo(self):
+        """Beat period from the autocorrelation of the recent onset strengths"""
+        length = len(self._history)
+        envelope = self._history
+        if self._count > length:
+            envelope = roll(envelope, -(self._count % length))
+        else:
+            envelope = envelope[:self._count]
+        envelope = envelope - envelope.mean()
+
+        autocorrelation = correlate(envelope, envelope, 'full')[len(envelope) - 1:]
+        if autocorrelation[0] <= 0 or self._lags[-1] + 1 >= len(autocorrelation):
+            return
+        score = autocorrelation[self._lags] * self._prior
+        best = argmax(score)
+        if score[best] <= 0:
+            self.period = None
+            return
+
+        # interpolate between the neighboring lags for a finer period
+        lag = float(self._lags[best])
+        if 0 < best < len(score) - 1:
+            left, middle, right = score[best - 1:best + 2]
+            curvature = left - 2 * middle + right
+            if curvature < 0:
+                lag += 0.5 * (left - right) / curvature
+        self.period = lag
@@ -0,0 +1,224 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Write the lights on port expanders a whole port register at a time.
+
+wiringPi drives the pins of a port expander one at a time: every
+digitalWrite to an expander pin sends the whole output latch of its port
+with that one bit changed, so a frame changing 16 channels of an
+mcp23017 is 16 i2c transfers.  A PortWriter groups the on / off channels
+by the expander they are on, and writes the output latch of each
+expander with a changed channel once per frame, both ports of an
+mcp23017 / mcp23s17 in a single transfer.  A 64 channel rig on four
+mcp23017 is at most 4 transfers per frame.
+
+wiringPi sets up the mcp23x17 with IOCON.SEQOP set, which disables
+sequential addressing, and IOCON.BANK clear.  With BANK = 0 the address
+pointer toggles between the A and B register of a pair instead, so a
+two byte write starting at OLATA writes OLATA then OLATB.  Don't change
+IOCON to get sequential writes, they aren't needed.
+
+Supported expanders:
+
+mcp23017 - i2c, 16 pins, OLATA and OLATB written with one 16 bit write
+mcp23s17 - spi, 16 pins, OLATA and OLATB written with one 4 byte transfer
+pcf8574  - i2c, 8 pins, the port written with one byte
+
+The expanders are still set up by wiringPi (hardware_controller's
+enable_device) and their pins made outputs by pinMode, the PortWriter
+only takes over the output latches.  Expanders with a channel on
+wiringPi's soft pwm are left to wiringPi, as soft pwm writes their pins
+behind our back (the single_thread pwm engine writes its channels
+through the PortWriter, see soft_pwm.py).  Expander pins that aren't
+used by a channel are written low.
+
+Third party dependencies:
+
+wiringpi2: python wrapper around wiring pi, for the i2c and spi transfers
+    https://github.com/WiringPi/WiringPi2-Python
+"""
+import abc
+import logging
+import threading
+
+# mcp23x17 registers (IOCON.BANK = 0)
+_MCP23X17_OLATA = 0x14
+
+# mcp23s17 spi write opcode (the device address is or'ed in)
+_MCP23S17_WRITE = 0x40
+
+
+class Expander(object):
+    """A port expander whose output latch is written whole"""
+
+    __metaclass__ = abc.ABCMeta
+
+    # Number of pins of the expander
+    num_pins = 8
+
+    def __init__(self, bus, pin_base):
+        """
+        :param bus: wiringpi (or a stand in) for the transfers
+        :type bus: module
+
+        :param pin_base: first wiringPi pin number of the expander
+        :type pin_base: int
+        """
+        self.bus = bus
+        self.pin_base = pin_base
+        self.latch = 0
+        self.transfers = 0
+
+    def has_pin(self, pin):
+        """Is the wiringPi pin number one of the expander's pins"""
+        return self.pin_base <= pin < self.pin_base + self.num_pins
+
+    def write(self):
+        """Write the output latch to the expander"""
+        self.transfers += 1
+        self._write(self.latch)
+
+    @abc.abstractmethod
+    def _write(self, latch):
+        """Send the output latch to the device"""
+
+
+class Mcp23017(Expander):
+    """mcp23017, 16 pins over i2c"""
+
+    num_pins = 16
+
+    def __init__(self, bus, pin_base, i2c_address):
+        super(Mcp23017, self).__init__(bus, pin_base)
+        self._fd = bus.wiringPiI2CSetup(i2c_address)
+
+    def _write(self, latch):
+        # OLATA then OLATB (IOCON.BANK = 0 toggles between them), low byte first
+        self.bus.wiringPiI2CWriteReg16(self._fd, _MCP23X17_OLATA, latch)
+
+
+class Mcp23s17(Expander):
+    """mcp23s17, 16 pins over spi"""
+
+    num_pins = 16
+
+    def __init__(self, bus, pin_base, spi_port, dev_id):
+        super(Mcp23s17, self).__init__(bus, pin_base)
+        self._spi_port = spi_port
+        self._opcode = _MCP23S17_WRITE | ((dev_id & 7) << 1)
+
+    def _write(self, latch):
+        data = bytearray([self._opcode, _MCP23X17_OLATA, latch & 0xff, latch >> 8])
+        self.bus.wiringPiSPIDataRW(self._spi_port, str(data))
+
+
+class Pcf8574(Expander):
+    """pcf8574, 8 pins over i2c"""
+
+    def __init__(self, bus, pin_base, i2c_address):
+        super(Pcf8574, self).__init__(bus, pin_base)
+        self._fd = bus.wiringPiI2CSetup(i2c_address)
+
+    def _write(self, latch):
+        self.bus.wiringPiI2CWrite(self._fd, latch)
+
+
+def expanders(bus, devices):
+    """
+    The expanders of the devices configuration that support port writes
+
+    :param bus: wiringpi (or a stand in) for the transfers
+    :type bus: module
+
+    :param devices: the devices configuration (configuration_manager.hardware)
+    :type devices: dict
+
+    :return: the expanders
+    :rtype: list
+    """
+    found = list()
+    for device, slaves in devices.items():
+        device = device.lower()
+        for params in slaves:
+            if device == "mcp23017":
+                found.append(Mcp23017(bus, int(params['pinBase']),
+                                      int(params['i2cAddress'], 16)))
+            elif device == "mcp23s17":
+                found.append(Mcp23s17(bus, int(params['pinBase']),
+                                      int(params['spiPort'], 16),
+                                      int(params['devId'])))
+            elif device == "pcf8574":
+                found.append(Pcf8574(bus, int(params['pinBase']),
+                                     int(params['i2cAddress'], 16)))
+    return found
+
+
+class PortWriter(object):
+    """
+    Writes the on / off channels on port expanders a port at a time
+
+    Typical usage:
+
+    writer = PortWriter(wiringpi, cm.hardware()['devices'], _GPIO_PINS, _PWM_PINS)
+    if writer.on_port[i]:
+        writer.write([i], [value])
+    """
+
+    def __init__(self, bus, devices, pins, pwm):
+        """
+        :param bus: wiringpi (or a stand in) for the transfers
+        :type bus: module
+
+        :param devices: the devices configuration (configuration_manager.hardware)
+        :type devices: dict
+
+        :param pins: wiringPi pin number of each channel
+        :type pins: list
+
+        :param pwm: is each channel a pwm channel written by wiringPi's soft pwm
+        :type pwm: list
+        """
+        self.on_port = [False] * len(pins)
+        self.expanders = list()
+        self._lock = threading.Lock()
+        self._bits = [None] * len(pins)
+        for expander in expanders(bus, devices):
+            channels = [i for i, pin in enumerate(pins) if expander.has_pin(pin)]
+            if any(pwm[i] for i in channels):
+                logging.info("Expander at pin base %d has pwm channels, it is written a pin "
+                             "at a time", expander.pin_base)
+                continue
+            for i in channels:
+                self.on_port[i] = True
+                self._bits[i] = (expander, 1 << (pins[i] - expander.pin_base))
+            if channels:
+                self.expanders.append(expander)
+
+    @property
+    def transfers(self):
+        """Number of transfers to the expanders so far"""
+        return sum(expander.transfers for expander in self.expanders)
+
+    def write(self, channels, values):
+        """
+        Set channels on ports, writing each changed expander once
+
+        Safe to call from the pwm thread and the lights at the same time.
+
+        :param channels: channels (0 based) that are on_port
+        :type channels: list
+
+        :param values: pin value of each channel (0 or 1)
+        :type values: list
+        """
+        with self._lock:
+            changed = set()
+            for i, value in zip(channels, values):
+                expander, bit = self._bits[i]
+                if value:
+                    expander.latch |= bit
+                else:
+                    expander.latch &= ~bit
+                changed.add(expander)
+            for expander in changed:
+                expander.write()
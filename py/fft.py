@@ -6,7 +6,10 @@
 
 """FFT methods for computing / analyzing frequency response of audio.
 
-This is simply a wrapper around FFT support in numpy.
+This is a wrapper around the FFT support in numpy (or scipy when it is
+installed).  The fastest FFT backend differs a lot between Raspberry Pi
+models and numpy / scipy builds, select_backend can time each of them
+once and remember the winner.
 
 Initial FFT code inspired from the code posted here:
 http://www.raspberrypi.org/phpBB3/viewtopic.php?t=35838&p=454041
@@ -17,15 +20,679 @@ http://www.instructables.com/id/Raspberry-Pi-Spectrum-Analyzer-with-RGB-LED-Stri
 Third party dependencies:
 
 numpy: for FFT calculation - http://www.numpy.org/
+scipy: optional, sparse band matrices for large channel counts and an
+    alternative FFT backend - http://www.scipy.org/
 """
-from numpy import sum as npsum
-from numpy import abs as npabs
-from numpy import log10, frombuffer, empty, hanning, fft, delete, int16, zeros
+import json
+import logging
+import platform
+import time
+from collections import OrderedDict
+
+import numpy
+from numpy import log10, frombuffer, empty, hanning, fft, int16, zeros, multiply, \
+    greater, where, ndarray, arange, array, abs as npabs, log, maximum, argmin, add, subtract, \
+    exp, pi, conjugate, allclose
+from numpy.random import uniform
+from numpy.lib.stride_tricks import as_strided
+
+try:
+    from scipy.sparse import csr_matrix
+except ImportError:
+    csr_matrix = None
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    from scipy import fftpack
+except ImportError:
+    fftpack = None
+
+BAND_SHAPES = ('rectangular', 'triangular', 'constant_q', 'mel')
+
+CHANNEL_MODES = ('left', 'mono', 'stereo', 'mid_side')
+
+
+def _numpy_backend(chunk_size):
+    """numpy.fft.rfft"""
+    def power_spectrum(windowed, out):
+        fourier = fft.rfft(windowed)[..., :out.shape[-1]]
+        multiply(fourier.real, fourier.real, out=out)
+        out += multiply(fourier.imag, fourier.imag, dtype=out.dtype)
+        return out
+    return power_spectrum
+
+
+def _scipy_power_spectrum(windowed, out):
+    """Power spectrum with scipy.fft.rfft"""
+    fourier = scipy_fft.rfft(windowed)[..., :out.shape[-1]]
+    multiply(fourier.real, fourier.real, out=out)
+    out += multiply(fourier.imag, fourier.imag, dtype=out.dtype)
+    return out
+
+
+def _fftpack_power_spectrum(windowed, out):
+    """Power spectrum with scipy.fftpack.rfft"""
+    # [y(0), Re(y(1)), Im(y(1)), ..., Re(y(n/2))]
+    packed = fftpack.rfft(windowed)
+    multiply(packed[..., 0], packed[..., 0], out=out[..., 0])
+    multiply(packed[..., 1:-1:2], packed[..., 1:-1:2], out=out[..., 1:])
+    out[..., 1:] += multiply(packed[..., 2::2], packed[..., 2::2], dtype=out.dtype)
+    return out
+
+
+def _scipy_backend(chunk_size):
+    """scipy.fft.rfft, or scipy.fftpack.rfft for older versions of scipy
+
+    Both keep float32 input in single precision.  fftpack returns the
+    spectrum packed as real numbers, which is squared directly.
+    """
+    if scipy_fft is not None:
+        return _scipy_power_spectrum
+    if fftpack is not None:
+        return _fftpack_power_spectrum
+    return None
+
+
+def _packed_backend(chunk_size):
+    """Real FFT computed with a complex FFT of half the size (power of two sizes)
+
+    The even samples are packed into the real part and the odd samples
+    into the imaginary part of a chunk_size / 2 point complex FFT, which
+    is then split back into the spectrum of the real input.
+    """
+    if chunk_size < 4 or chunk_size & (chunk_size - 1):
+        return None
+
+    half = chunk_size // 2
+    twiddle = exp(-2j * pi * arange(half) / chunk_size)
+    mirror = -arange(half) % half
+
+    def power_spectrum(windowed, out):
+        packed = fft.fft(windowed[..., ::2] + 1j * windowed[..., 1::2])
+        mirrored = conjugate(packed[..., mirror])
+        fourier = (packed + mirrored) * 0.5
+        fourier += twiddle * (packed - mirrored) * -0.5j
+        multiply(fourier.real, fourier.real, out=out)
+        out += multiply(fourier.imag, fourier.imag, dtype=out.dtype)
+        return out
+    return power_spectrum
+
+
+# Backends picked by select_backend('auto') in this process, by tuning key
+_selected_backends = dict()
+
+# Available FFT backends, each a function of the chunk size returning a
+# power_spectrum(windowed, out) function (or None if it can't be used)
+FFT_BACKENDS = OrderedDict([('numpy', _numpy_backend),
+                            ('scipy', _scipy_backend),
+                            ('packed', _packed_backend)])
+
+
+def available_backends(chunk_size):
+    """Names of the FFT backends that can be used for chunk_size
+
+    :param chunk_size: chunk size of audio data
+    :type chunk_size: int
+
+    :return: backend names
+    :rtype: list
+    """
+    return [name for name, backend in FFT_BACKENDS.items() if backend(chunk_size) is not None]
+
+
+def source_count(channel_mode, input_channels):
+    """Number of audio channels AnalysisPlan analyzes per chunk
+
+    :param channel_mode: one of CHANNEL_MODES
+    :type channel_mode: str
+
+    :param input_channels: number of channels in the audio
+    :type input_channels: int
+
+    :return: 2 for stereo and mid_side on audio with 2 or more channels, else 1
+    :rtype: int
+    """
+    if input_channels > 1 and channel_mode in ('stereo', 'mid_side'):
+        return 2
+    return 1
+
+
+def autotune(chunk_size, dtype='float64', num_sources=1, repeat=200):
+    """Time each available FFT backend and return the fastest
+
+    Backends whose results don't match numpy's are skipped.
+
+    :param chunk_size: chunk size of audio data
+    :type chunk_size: int
+
+    :param dtype: analysis dtype
+    :type dtype: str
+
+    :param num_sources: audio channels analyzed per chunk (see AnalysisPlan)
+    :type num_sources: int
+
+    :param repeat: number of FFTs to time for each backend
+    :type repeat: int
+
+    :return: name of the fastest backend and the seconds per FFT of each
+    :rtype: tuple
+    """
+    windowed = uniform(-32768, 32767, (num_sources, chunk_size)).astype(dtype)
+    out = empty((num_sources, chunk_size // 2), dtype=dtype)
+    expected = _numpy_backend(chunk_size)(windowed, out).copy()
+
+    timings = dict()
+    for name in available_backends(chunk_size):
+        power_spectrum = FFT_BACKENDS[name](chunk_size)
+        result = power_spectrum(windowed, out)
+        if not allclose(result, expected, rtol=1e-3, atol=1e-3 * expected.max()):
+            logging.warning("FFT backend %s gives wrong results, not using it", name)
+            continue
+
+        start = time.time()
+        for _ in range(repeat):
+            power_spectrum(windowed, out)
+        timings[name] = (time.time() - start) / repeat
+
+    return min(timings, key=timings.get), timings
+
+
+def select_backend(name, chunk_size, dtype='float64', num_sources=1, tuning_filename=None):
+    """Resolve the configured FFT backend name
+
+    'auto' picks the fastest backend with autotune.  The result is stored
+    in tuning_filename (if given) so the timing is only done once for each
+    chunk size, dtype, number of sources and numpy / scipy version on a
+    machine, and kept for the rest of the process, so it is cheap to call
+    every time a plan is built.
+
+    :param name: an FFT_BACKENDS name, or 'auto'
+    :type name: str
+
+    :param chunk_size: chunk size of audio data
+    :type chunk_size: int
+
+    :param dtype: analysis dtype
+    :type dtype: str
+
+    :param num_sources: audio channels analyzed per chunk (see AnalysisPlan)
+    :type num_sources: int
+
+    :param tuning_filename: json file to keep autotune results in
+    :type tuning_filename: str
+
+    :return: name of the backend to use
+    :rtype: str
+    """
+    if name != 'auto':
+        if name not in available_backends(chunk_size):
+            logging.warning("FFT backend %s is not available, using numpy", name)
+            return 'numpy'
+        return name
+
+    scipy_version = 'none'
+    if scipy_fft is not None or fftpack is not None:
+        import scipy
+        scipy_version = scipy.__version__
+    key = "%s chunk_size=%d dtype=%s sources=%d numpy=%s scipy=%s" % \
+        (platform.machine(), chunk_size, dtype, num_sources, numpy.__version__, scipy_version)
+    if key in _selected_backends:
+        return _selected_backends[key]
+
+    tunings = dict()
+    if tuning_filename:
+        try:
+            with open(tuning_filename) as tuning_file:
+                tunings = json.load(tuning_file)
+        except (IOError, ValueError):
+            pass
+
+    if key in tunings and tunings[key]['backend'] in available_backends(chunk_size):
+        _selected_backends[key] = tunings[key]['backend']
+        return _selected_backends[key]
+
+    best, timings = autotune(chunk_size, dtype, num_sources)
+    logging.info("FFT backend autotune for %s: %s, using %s", key, timings, best)
+
+    if tuning_filename:
+        tunings[key] = {'backend': best, 'timings': timings}
+        try:
+            with open(tuning_filename, 'w') as tuning_file:
+                json.dump(tunings, tuning_file, indent=4, sort_keys=True)
+        except IOError as error:
+            logging.warning("Could not save FFT backend autotune results: %s", error)
+
+    _selected_backends[key] = best
+    return best
+
+
+def _mel(frequency):
+    """Convert a frequency in Hz to the mel scale"""
+    return 2595.0 * log10(1.0 + frequency / 700.0)
+
+
+def band_weights(frequency_limits, chunk_size, sample_rate, shape='rectangular'):
+    """Weight of each power spectrum bin in each frequency band
+
+    rectangular - every bin between low and high counts fully (the classic
+                  lightshowpi bands)
+    triangular  - bins are weighted by a triangle peaking at the center of the
+                  band, reaching half weight at low and high and extending half
+                  a band width into each neighbor, so adjacent bands overlap
+    constant_q  - triangular on a log frequency axis, each band keeps the same
+                  shape relative to its center frequency
+    mel         - triangular on the mel scale, which follows the ear's pitch
+                  resolution
+
+    Bands may overlap or repeat (e.g. custom_channel_bands), each row of the
+    matrix is independent.
+
+    :param frequency_limits: list of (low, high) frequency tuples, one per band
+    :type frequency_limits: list
+
+    :param chunk_size: chunk size of audio data
+    :type chunk_size: int
+
+    :param sample_rate: audio sample rate
+    :type sample_rate: int
+
+    :param shape: one of BAND_SHAPES
+    :type shape: str
+
+    :return: one row of chunk_size / 2 bin weights per band
+    :rtype: numpy.array
+    """
+    if shape not in BAND_SHAPES:
+        raise ValueError("Unknown band shape '%s', must be one of %s" % (shape, BAND_SHAPES))
+
+    spectrum_size = chunk_size // 2
+    frequencies = arange(spectrum_size) * float(sample_rate) / chunk_size
+    weights = zeros((len(frequency_limits), spectrum_size), dtype='float64')
+
+    for band, (low, high) in enumerate(frequency_limits):
+        if shape == 'rectangular':
+            # Get the power array index corresponding to a particular frequency.
+            idx1 = int(chunk_size * low / sample_rate)
+            idx2 = int(chunk_size * high / sample_rate)
+
+            # if index1 is the same as index2 the value is an invalid value
+            # we can fix this by incrementing index2 by 1, This is a temporary fix
+            # for RuntimeWarning: invalid value encountered in double_scalars
+            # generated while calculating the standard deviation.  This warning
+            # results in some channels not lighting up during playback.
+            if idx1 == idx2:
+                idx2 += 1
+
+            weights[band, idx1:idx2] = 1.0
+            continue
+
+        if shape == 'mel':
+            axis, low, high = _mel(frequencies), _mel(low), _mel(high)
+        elif shape == 'constant_q' and low > 0:
+            axis, low, high = log(maximum(frequencies, 1e-3)), log(low), log(high)
+        else:
+            axis = frequencies
+
+        center = (low + high) / 2.0
+        width = max(high - low, 1e-9)
+        weights[band] = maximum(0.0, 1.0 - npabs(axis - center) / width)
+
+        # a band narrower than a bin still gets its nearest bin
+        if not weights[band].any():
+            weights[band, min(argmin(npabs(axis - center)), spectrum_size - 1)] = 1.0
+
+    return weights
+
+
+class AnalysisPlan(object):
+    """Precomputed FFT analysis for a fixed chunk size and set of frequency bands
+
+    Everything that does not change from one chunk of audio to the next
+    (the window, the power spectrum bin weights for each channel and the
+    work buffers) is computed once when the plan is created, so analyzing
+    a chunk is just a window multiply, an FFT and a single (sparse when
+    scipy is available) matrix product that sums the power spectrum into
+    the channel bands.
+
+    Channels that share a band (e.g. mirrored custom_channel_mapping) are
+    only summed once.
+
+    The audio channels analyzed depend on channel_mode (see CHANNEL_MODES):
+
+    left     - the first (left) audio channel only
+    mono     - a downmix of all the audio channels
+    stereo   - the left channel drives the first half of the light channels
+               and the right channel the second half
+    mid_side - the mid (left + right) downmix drives the first half of the
+               light channels and the side (left - right) the second half
+
+    Interleaved samples are read through strided views, and stereo and
+    mid_side analyze both halves with a single rfft.  Mono audio is always
+    analyzed as a single channel.
+
+    With dtype='float32' the window, FFT input, power spectrum and levels
+    are all single precision, halving the memory traffic on 32 bit boards.
+    The int16 samples are windowed straight into the float32 buffer (numpy's
+    FFT itself still computes in double precision internally, the scipy
+    backend does not).
+
+    backend names the FFT_BACKENDS entry used for the transform, see
+    select_backend to pick the fastest one for this machine.
+
+    Typical usage:
+
+    plan = AnalysisPlan(CHUNK_SIZE, sample_rate, frequency_limits, hc.GPIOLEN, num_channels)
+    matrix = plan.calculate_levels(data)
+    """
+
+    def __init__(self, chunk_size, sample_rate, frequency_limits, num_bins, input_channels=2,
+                 band_shape='rectangular', dtype='float64', channel_mode='left', backend='numpy'):
+        if channel_mode not in CHANNEL_MODES:
+            raise ValueError("Unknown channel mode '%s', must be one of %s"
+                             % (channel_mode, CHANNEL_MODES))
+        if backend not in FFT_BACKENDS:
+            raise ValueError("Unknown FFT backend '%s', must be one of %s"
+                             % (backend, tuple(FFT_BACKENDS)))
+        self._power_spectrum = FFT_BACKENDS[backend](chunk_size)
+        if self._power_spectrum is None:
+            raise ValueError("FFT backend '%s' can't be used with a chunk size of %d"
+                             % (backend, chunk_size))
+        self.backend = backend
+
+        self.chunk_size = chunk_size
+        self.sample_rate = sample_rate
+        self.frequency_limits = frequency_limits
+        self.num_bins = num_bins
+        self.input_channels = input_channels
+        self.dtype = dtype
+
+        if input_channels < 2 and channel_mode != 'left':
+            channel_mode = 'mono'
+        self.channel_mode = channel_mode
+
+        # if you take an FFT of a chunk of audio, the edges will look like
+        # super high frequency cutoffs. Applying a window tapers the edges
+        # of each end of the chunk down to zero.
+        self.window = hanning(chunk_size).astype(dtype)
+
+        # Downmixes average the audio channels, fold that into the window
+        if channel_mode == 'mono':
+            self._mix_window = self.window / input_channels
+        else:
+            self._mix_window = self.window / 2
+
+        # The last element of the rfft is dropped to make the power spectrum
+        # the same size as chunk_size / 2
+        self.spectrum_size = chunk_size // 2
+
+        # Split the light channels between the analyzed audio channels
+        self.num_sources = source_count(channel_mode, input_channels)
+        group_size = -(-num_bins // self.num_sources)
+        self.channel_sources = array([pin // group_size for pin in range(num_bins)])
+
+        # Each distinct band is computed once, channels index into the bands
+        unique_bands = []
+        channel_bands = []
+        for pin in range(num_bins):
+            band = tuple(frequency_limits[pin])
+            if band not in unique_bands:
+                unique_bands.append(band)
+            channel_bands.append(unique_bands.index(band))
+        self.channel_bands = array(channel_bands)
+
+        # Each row of the band matrix weights the power spectrum bins that
+        # make up a band, so summing every band is a single matrix product
+        self.weights = band_weights(unique_bands, chunk_size, sample_rate, band_shape).astype(dtype)
+        if csr_matrix is not None:
+            self.weights = csr_matrix(self.weights)
+
+        # Preallocated work buffers, reused for every chunk
+        self._samples = zeros((self.num_sources, chunk_size), dtype=dtype)
+        self._power = empty((self.num_sources, self.spectrum_size), dtype=dtype)
+
+        # The power spectrum of the last chunk(s) analyzed, for the beat tracker
+        self.power = self._power
+
+    def _window_sources(self, frames, out):
+        """Window each analyzed audio channel of frames into out
+
+        :param frames: interleaved int16 samples, chunk_size frames in the last axis
+        :type frames: numpy.array
+
+        :param out: buffer with a (num_sources, chunk_size) shape in the last axes
+        :type out: numpy.array
+        """
+        channels = self.input_channels
+        left = frames[..., ::channels]
+
+        if self.channel_mode == 'left':
+            multiply(left, self.window, out=out[..., 0, :])
+        elif self.channel_mode == 'mono':
+            mix = out[..., 0, :]
+            mix[...] = left
+            for channel in range(1, channels):
+                add(mix, frames[..., channel::channels], out=mix)
+            multiply(mix, self._mix_window, out=mix)
+        elif self.channel_mode == 'stereo':
+            multiply(left, self.window, out=out[..., 0, :])
+            multiply(frames[..., 1::channels], self.window, out=out[..., 1, :])
+        else:
+            right = frames[..., 1::channels]
+            add(left, right, out=out[..., 0, :], dtype=self.dtype)
+            subtract(left, right, out=out[..., 1, :], dtype=self.dtype)
+            multiply(out, self._mix_window, out=out)
+
+    def calculate_levels(self, data):
+        """Calculate frequency response for each channel of a chunk of audio
+
+        :param data: decoder.frames() or SampleRing.samples(), audio data for fft calculations
+        :type data: decoder.frames or numpy.array
+
+        :return: log10 of the power in each channel band (0 where there is no power)
+        :rtype: numpy.array
+        """
+        if not isinstance(data, ndarray):
+            data = frombuffer(data, dtype=int16)
+
+        # the final chunk of a song is usually short, zero fill the rest
+        length = self.chunk_size * self.input_channels
+        if len(data) != length:
+            frames = zeros(length, dtype=int16)
+            frames[:min(len(data), length)] = data[:length]
+            data = frames
+
+        self._window_sources(data, self._samples)
+
+        # Apply FFT - real data - and calculate the power spectrum
+        self._power_spectrum(self._samples, self._power)
+        self.power = self._power
+
+        sums = self.weights.dot(self._power.T)
+
+        return _log_levels(sums)[self.channel_bands, self.channel_sources]
+
+    def calculate_levels_batch(self, frames):
+        """Calculate frequency response for many chunks of audio at once
+
+        All chunks are windowed together and transformed with a single rfft
+        over the frames axis, which removes the per chunk python overhead
+        when analyzing a whole song (see frames_from_pcm).  The FFT itself
+        costs the same either way and takes most of the time, so this is
+        only modestly faster than calculate_levels (see
+        tools/analysis_benchmark.py).
+
+        :param frames: one chunk of interleaved int16 samples per row
+        :type frames: numpy.array
+
+        :return: one row of channel levels per chunk
+        :rtype: numpy.array
+        """
+        num_rows = len(frames)
+        windowed = empty((num_rows, self.num_sources, self.chunk_size), dtype=self.dtype)
+        self._window_sources(frames, windowed)
+
+        # Apply FFT - real data, one chunk per row - and calculate the power spectrum
+        power = empty((num_rows, self.num_sources, self.spectrum_size), dtype=self.dtype)
+        self._power_spectrum(windowed, power)
+        self.power = power
+
+        sums = self.weights.dot(power.reshape(-1, self.spectrum_size).T)
+        sums = sums.reshape(-1, num_rows, self.num_sources)
+
+        return _log_levels(sums)[self.channel_bands, :, self.channel_sources].T
+
+
+class SampleRing(object):
+    """Ring buffer holding the most recent chunk_size frames of decoded audio
+
+    Audio is pushed in hops of hop_size frames and analyzed over the last
+    chunk_size frames, so the lights can be updated more often than once
+    per FFT window by using overlapping windows.  When hop_size equals
+    chunk_size every window is a separate chunk of audio.
+
+    Each sample is stored twice, chunk_size frames apart, so the latest
+    window is always available as a contiguous view without copying.
+
+    Typical usage:
+
+    ring = SampleRing(CHUNK_SIZE, HOP_SIZE, num_channels)
+    ring.push(musicfile.readframes(HOP_SIZE))
+    matrix = plan.calculate_levels(ring.samples())
+    """
+
+    def __init__(self, chunk_size, hop_size, input_channels=2):
+        self.chunk_size = chunk_size
+        self.hop_size = hop_size
+        self.input_channels = input_channels
+        self._length = chunk_size * input_channels
+        self._hop_length = hop_size * input_channels
+        self._buffer = zeros(2 * self._length, dtype=int16)
+        self._position = 0
+
+    def push(self, data):
+        """Add one hop of audio to the ring
+
+        A short final read is zero filled to a full hop, so the end of a
+        song is analyzed as if it were followed by silence.
+
+        :param data: decoder.frames(), up to hop_size frames of audio
+        :type data: decoder.frames
+        """
+        samples = frombuffer(data, dtype=int16)
+        if len(samples) < self._hop_length:
+            padded = zeros(self._hop_length, dtype=int16)
+            padded[:len(samples)] = samples
+            samples = padded
+        samples = samples[-self._length:]
+
+        start = self._position
+        end = start + len(samples)
+        if end <= self._length:
+            self._buffer[start:end] = samples
+            self._buffer[start + self._length:end + self._length] = samples
+        else:
+            split = self._length - start
+            self._buffer[start:self._length] = samples[:split]
+            self._buffer[start + self._length:] = samples[:split]
+            self._buffer[:end - self._length] = samples[split:]
+            self._buffer[self._length:end] = samples[split:]
+        self._position = end % self._length
+
+    def samples(self):
+        """The latest chunk_size frames of interleaved audio, oldest first
+
+        :return: view of the ring (valid until the next push)
+        :rtype: numpy.array
+        """
+        return self._buffer[self._position:self._position + self._length]
+
+    def frames(self, data):
+        """Push a block of many hops and return every window it produces
+
+        This is the batched equivalent of calling push and samples once per
+        hop, for use with AnalysisPlan.calculate_levels_batch.
+
+        :param data: decoder.frames(), audio data covering one or more hops
+        :type data: decoder.frames
+
+        :return: one window of interleaved int16 samples per hop, as a
+        read only view with overlapping rows
+        :rtype: numpy.array
+        """
+        samples = frombuffer(data, dtype=int16)
+        num_rows = -(-len(samples) // self._hop_length)
+
+        # the current window followed by the new hops
+        history = zeros(self._length + num_rows * self._hop_length, dtype=int16)
+        history[:self._length] = self.samples()
+        history[self._length:self._length + len(samples)] = samples
+
+        # keep the ring in step with the block
+        self._buffer[:self._length] = history[-self._length:]
+        self._buffer[self._length:] = history[-self._length:]
+        self._position = 0
+
+        item_size = history.itemsize
+        rows = as_strided(history[self._hop_length:],
+                          shape=(num_rows, self._length),
+                          strides=(self._hop_length * item_size, item_size))
+        rows.flags.writeable = False
+        return rows
+
+
+def _log_levels(sums):
+    """Take the log10 of the band power sums
+
+    The log10 of the resulting sum is used to approximate how human ears
+    perceive sound levels.
+    """
+    # if the sum is 0 lets not take log10, just use 0
+    # eliminates RuntimeWarning: divide by zero encountered in log10, does not insert -inf
+    positive = greater(sums, 0)
+    return where(positive, log10(where(positive, sums, 1.0)), 0.0)
+
+
+def frames_from_pcm(data, chunk_size, input_channels=2):
+    """Split a block of decoded audio into a matrix of chunks
+
+    The final chunk is zero filled when the audio does not divide evenly
+    into chunks, matching how a short final read is analyzed one chunk at
+    a time.
+
+    :param data: decoder.frames(), audio data covering one or more chunks
+    :type data: decoder.frames
+
+    :param chunk_size: chunk size of audio data
+    :type chunk_size: int
+
+    :param input_channels: number of interleaved audio channels (default=2)
+    :type input_channels: int
+
+    :return: one chunk of interleaved int16 samples per row
+    :rtype: numpy.array
+    """
+    samples = frombuffer(data, dtype=int16)
+    row_length = chunk_size * input_channels
+    num_rows = -(-len(samples) // row_length)
+
+    if len(samples) == num_rows * row_length:
+        return samples.reshape(num_rows, row_length)
+
+    frames = zeros((num_rows, row_length), dtype=int16)
+    frames.flat[:len(samples)] = samples
+    return frames
 
 
 def calculate_levels(data, chunk_size, sample_rate, frequency_limits, num_bins, input_channels=2):
     """Calculate frequency response for each channel defined in frequency_limits
 
+    Convenience wrapper that builds a one-off AnalysisPlan, callers analyzing
+    more than one chunk should create an AnalysisPlan once and reuse it.
+
     :param data: decoder.frames(), audio data for fft calculations
     :type data: decoder.frames
 
@@ -47,56 +714,5 @@ def calculate_levels(data, chunk_size, sample_rate, frequency_limits, num_bins,
     :return:
     :rtype: numpy.array
     """
-
-    # create a numpy array, taking just the left channel if stereo
-    data_stereo = frombuffer(data, dtype=int16)
-    if input_channels == 2:
-        # data has 2 bytes per channel
-        data = empty(len(data) / (2 * input_channels))
-
-        # pull out the even values, just using left channel
-        data[:] = data_stereo[::2]
-    elif input_channels == 1:
-        data = data_stereo
-
-    # if you take an FFT of a chunk of audio, the edges will look like
-    # super high frequency cutoffs. Applying a window tapers the edges
-    # of each end of the chunk down to zero.
-    data = data * hanning(len(data))
-
-    # Apply FFT - real data
-    fourier = fft.rfft(data)
-
-    # Remove last element in array to make it the same size as chunk_size
-    fourier = delete(fourier, len(fourier) - 1)
-
-    # Calculate the power spectrum
-    power = npabs(fourier) ** 2
-
-    matrix = zeros(num_bins, dtype='float64')
-    for pin in range(num_bins):
-        # take the log10 of the resulting sum to approximate how human ears 
-        # perceive sound levels
-        
-        # Get the power array index corresponding to a particular frequency.
-        idx1 = int(chunk_size * frequency_limits[pin][0] / sample_rate)
-        idx2 = int(chunk_size * frequency_limits[pin][1] / sample_rate)
-        
-        # if index1 is the same as index2 the value is an invalid value
-        # we can fix this by incrementing index2 by 1, This is a temporary fix
-        # for RuntimeWarning: invalid value encountered in double_scalars
-        # generated while calculating the standard deviation.  This warning
-        # results in some channels not lighting up during playback.
-        if idx1 == idx2:
-            idx2 += 1
-        
-        npsums = npsum(power[idx1:idx2:1])
-        
-        # if the sum is 0 lets not take log10, just use 0
-        # eliminates RuntimeWarning: divide by zero encountered in log10, does not insert -inf
-        if npsums == 0:
-            matrix[pin] = 0
-        else:
-            matrix[pin] = log10(npsums)
-
-    return matrix
+    plan = AnalysisPlan(chunk_size, sample_rate, frequency_limits, num_bins, input_channels)
+    return plan.calculate_levels(data)
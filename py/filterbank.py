@@ -0,0 +1,213 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Low latency IIR filterbank analysis of audio.
+
+An alternative to the FFT analysis in fft.py for audio-in mode.  Each
+channel band is a cascade of second order (biquad) band-pass filters
+followed by an envelope follower.  The filters keep their state between reads, so small
+periods (128 - 256 frames) can be analyzed as they arrive instead of
+waiting for a full FFT window of audio, keeping the delay between the
+audio and the lights well under 10 ms.
+
+Filter coefficients are from Robert Bristow-Johnson's Audio EQ Cookbook:
+http://www.musicdsp.org/files/Audio-EQ-Cookbook.txt
+
+Third party dependencies:
+
+numpy: for the filter math - http://www.numpy.org/
+scipy: runs the filters in compiled code - http://www.scipy.org/
+"""
+from numpy import log10, frombuffer, int16, zeros, array, cos, sin, sinh, log, log2, pi, \
+    sqrt, exp, where, greater, ndarray, convolve
+
+from fft import CHANNEL_MODES
+
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+
+
+def biquad_coefficients(low, high, sample_rate):
+    """Biquad filter passing the frequencies between low and high
+
+    A band-pass filter centered (geometrically) between low and high, a
+    low-pass filter when low is 0 and a high-pass filter when high is
+    at or above the nyquist frequency.
+
+    :param low: low frequency of the band
+    :type low: float
+
+    :param high: high frequency of the band
+    :type high: float
+
+    :param sample_rate: audio sample rate
+    :type sample_rate: int
+
+    :return: (b, a) filter coefficients normalized so a[0] is 1
+    :rtype: tuple
+    """
+    nyquist = sample_rate / 2.0
+    if low <= 0:
+        # low-pass at high
+        w0 = 2 * pi * min(high, 0.99 * nyquist) / sample_rate
+        alpha = sin(w0) / sqrt(2)
+        b = [(1 - cos(w0)) / 2, 1 - cos(w0), (1 - cos(w0)) / 2]
+    elif high >= nyquist:
+        # high-pass at low
+        w0 = 2 * pi * low / sample_rate
+        alpha = sin(w0) / sqrt(2)
+        b = [(1 + cos(w0)) / 2, -(1 + cos(w0)), (1 + cos(w0)) / 2]
+    else:
+        # band-pass with a 0 dB peak at the center of the band
+        w0 = 2 * pi * sqrt(low * high) / sample_rate
+        octaves = log2(float(high) / low)
+        alpha = sin(w0) * sinh(log(2) / 2 * octaves * w0 / sin(w0))
+        b = [alpha, 0.0, -alpha]
+
+    a = [1 + alpha, -2 * cos(w0), 1 - alpha]
+    return array(b) / a[0], array(a) / a[0]
+
+
+class FilterBank(object):
+    """Bank of band-pass filters with envelope followers, one per channel
+
+    Each band is sections identical biquads in series, every extra section
+    makes the band edges 6 dB / octave steeper so neighboring channels
+    respond less to each other.
+
+    The audio channels analyzed depend on channel_mode, as for
+    fft.AnalysisPlan (see fft.CHANNEL_MODES).
+
+    Running the filters a sample at a time in python is too slow for the
+    small periods read in audio-in mode, so scipy is required.
+
+    Typical usage:
+
+    bank = FilterBank(sample_rate, frequency_limits, hc.GPIOLEN, input_channels, channel_mode)
+    matrix = bank.calculate_levels(data)
+
+    The returned levels are on the same log10 power scale as
+    fft.calculate_levels (for an FFT of level_chunk_size frames), so the
+    same mean / std normalization works with either engine.
+    """
+
+    def __init__(self, sample_rate, frequency_limits, num_bins, input_channels=2,
+                 channel_mode='left', sections=2, attack=0.005, release=0.1,
+                 level_chunk_size=2048):
+        if lfilter is None:
+            raise ImportError("The filterbank engine needs scipy (sudo apt-get install "
+                              "python-scipy), or use audio_in_engine = fft")
+        if channel_mode not in CHANNEL_MODES:
+            raise ValueError("Unknown channel mode '%s', must be one of %s"
+                             % (channel_mode, CHANNEL_MODES))
+        self.sample_rate = sample_rate
+        self.frequency_limits = frequency_limits
+        self.num_bins = num_bins
+        self.input_channels = input_channels
+
+        if input_channels < 2 and channel_mode != 'left':
+            channel_mode = 'mono'
+        self.channel_mode = channel_mode
+
+        # Split the light channels between the analyzed audio channels
+        num_sources = 2 if channel_mode in ('stereo', 'mid_side') else 1
+        group_size = -(-num_bins // num_sources)
+        self.channel_sources = [pin // group_size for pin in range(num_bins)]
+
+        coefficients = [biquad_coefficients(frequency_limits[pin][0],
+                                            frequency_limits[pin][1],
+                                            sample_rate)
+                        for pin in range(num_bins)]
+
+        # Combine the identical sections into one higher order filter
+        self._b = array([_cascade(b, sections) for b, _ in coefficients])
+        self._a = array([_cascade(a, sections) for _, a in coefficients])
+        self.order = 2 * sections
+
+        # Filter state carried between reads (transposed direct form II)
+        self._state = zeros((num_bins, self.order))
+
+        # Envelope follower time constants, in seconds
+        self.attack = attack
+        self.release = release
+        self._envelope = zeros(num_bins)
+
+        # The power an FFT of level_chunk_size hanning windowed frames sees
+        # for a band with this mean square value (Parseval's theorem)
+        self._level_scale = 0.375 * level_chunk_size ** 2 / 2
+
+    @property
+    def power(self):
+        """Envelope power of each band after the last calculate_levels call"""
+        return self._envelope
+
+    def calculate_levels(self, data):
+        """Filter a period of audio and return the level of each channel
+
+        :param data: decoder.frames(), audio data of any length
+        :type data: decoder.frames
+
+        :return: log10 of the envelope power in each channel band
+        :rtype: numpy.array
+        """
+        if not isinstance(data, ndarray):
+            data = frombuffer(data, dtype=int16)
+
+        sources = self._sources(data)
+        if not len(sources[0]):
+            return _log_levels(self._envelope * self._level_scale)
+
+        power = self._filter(sources)
+
+        # Follow the band power with a fast attack and slow release, the
+        # smoothing factors depend on the length of this period.
+        seconds = len(sources[0]) / float(self.sample_rate)
+        rising = greater(power, self._envelope)
+        coefficient = where(rising,
+                            exp(-seconds / self.attack),
+                            exp(-seconds / self.release))
+        self._envelope = coefficient * self._envelope + (1 - coefficient) * power
+
+        return _log_levels(self._envelope * self._level_scale)
+
+    def _sources(self, data):
+        """The analyzed audio channels of interleaved samples, by channel_mode"""
+        channels = self.input_channels
+        left = data[::channels].astype('float64')
+        if self.channel_mode == 'left':
+            return [left]
+        if self.channel_mode == 'mono':
+            mix = left
+            for channel in range(1, channels):
+                mix += data[channel::channels]
+            return [mix / channels]
+        right = data[1::channels].astype('float64')
+        if self.channel_mode == 'stereo':
+            return [left, right]
+        return [(left + right) / 2, (left - right) / 2]
+
+    def _filter(self, sources):
+        """Run every filter over its audio channel and return the mean square output"""
+        power = zeros(self.num_bins)
+        for pin in range(self.num_bins):
+            output, self._state[pin] = lfilter(self._b[pin], self._a[pin],
+                                               sources[self.channel_sources[pin]],
+                                               zi=self._state[pin])
+            power[pin] = output.dot(output)
+        return power / len(sources[0])
+
+
+def _cascade(coefficients, sections):
+    """Polynomial coefficients of sections identical filters in series"""
+    combined = array([1.0])
+    for _ in range(sections):
+        combined = convolve(combined, coefficients)
+    return combined
+
+
+def _log_levels(power):
+    """log10 of the band power, 0 where there is no power"""
+    positive = greater(power, 0)
+    return where(positive, log10(where(positive, power, 1.0)), 0.0)
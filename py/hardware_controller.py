@@ -9,10 +9,13 @@
 """Control the raspberry pi hardware.
 
 The hardware controller handles all interaction with the raspberry pi
-hardware to turn the lights on and off.
+hardware to turn the lights on and off, through the output backend set
+by output_backend (see output_backends.py).
 
 Third party dependencies:
 
+numpy: for calculating whole frames of pin values - http://www.numpy.org/
+
 wiringpi2: python wrapper around wiring pi
     https://github.com/WiringPi/WiringPi2-Python
 """
@@ -24,9 +27,12 @@ import time
 import subprocess
 
 import configuration_manager as cm
+import expander_ports
+import numpy as np
+import output_backends
+import soft_pwm
 
 from wiring_pi_stub import WiringPiStub
-wiringpi = WiringPiStub.import_wiringpi2(logging)
 
 # Get Configurations - TODO(todd): Move more of this into configuration manager
 _CONFIG = cm.CONFIG
@@ -37,6 +43,10 @@ PIN_MODES = _CONFIG.get('hardware', 'pin_modes').split(',')
 
 _PWM_MAX = int(_CONFIG.get('hardware', 'pwm_range'))
 
+_PWM_ENGINE = _CONFIG.get('hardware', 'pwm_engine').strip().lower()
+
+_PWM_FREQUENCY = _CONFIG.getfloat('hardware', 'pwm_frequency')
+
 _ACTIVE_LOW_MODE = _CONFIG.getboolean('hardware', 'active_low_mode')
 
 _LIGHTSHOW_CONFIG = cm.lightshow()
@@ -53,6 +63,7 @@ _INVERTED_CHANNELS = \
     [int(channel) for channel in _LIGHTSHOW_CONFIG['invert_channels'].split(',')]
 
 _EXPORT_PINS = _CONFIG.getboolean('hardware', 'export_pins')
+_EXPANDER_PORT_WRITES = _CONFIG.getboolean('hardware', 'expander_port_writes')
 _GPIO_UTILITY_PATH = _CONFIG.get('hardware', 'gpio_utility_path')
 
 # Initialize GPIO
@@ -63,6 +74,7 @@ GPIOLEN = len(_GPIO_PINS)
 # If only a single pin mode is specified, assume all pins should be in that mode
 if len(PIN_MODES) == 1:
     PIN_MODES = [PIN_MODES[0] for _ in range(GPIOLEN)]
+_PWM_PINS = [mode.lower() == "pwm" for mode in PIN_MODES]
 
 # Check ActiveLowMode Configuration Setting
 if _ACTIVE_LOW_MODE:
@@ -78,6 +90,35 @@ else:
     _GPIOINACTIVE = 0
     _PWM_OFF = 0
 
+# Type of the pin values in a frame (see frame_values)
+FRAME_DTYPE = np.uint8 if _PWM_MAX <= 255 else np.uint16
+
+# Last value written to each pin, -1 when it isn't known.  Writing a pin
+# the value it already has is skipped, over i2c / spi expanders every
+# write is a bus transaction (see force_refresh and write_counts)
+_pin_values = np.empty(GPIOLEN, dtype=np.int32)
+_pin_values.fill(-1)
+
+_write_counts = {'written': 0, 'skipped': 0}
+
+# Where the pin writes go (see output_backends.py)
+_OUTPUT = output_backends.create(
+    _CONFIG.get('hardware', 'output_backend').strip().lower(),
+    _CONFIG.get('hardware', 'record_file').replace('$SYNCHRONIZED_LIGHTS_HOME', cm.HOME_DIR),
+    {'gpio_pins': _GPIO_PINS,
+     'pin_modes': PIN_MODES,
+     'pwm_range': _PWM_MAX,
+     'active_low_mode': _ACTIVE_LOW_MODE,
+     'dtype': np.dtype(FRAME_DTYPE).str})
+wiringpi = _OUTPUT.wiringpi
+
+# Writes the on / off channels on port expanders a port at a time, when
+# expander_port_writes is enabled (see expander_ports.py)
+_port_writer = None
+
+# Drives the pwm channels when pwm_engine is single_thread (see soft_pwm.py)
+_soft_pwm = None
+
 # Functions
 def enable_device():
     '''enable the specified device '''
@@ -161,7 +202,57 @@ def enable_device():
 
 def is_pin_pwm(i):
     """Is the pin setup for pwm"""
-    return PIN_MODES[i].lower() == "pwm"
+    return _PWM_PINS[i]
+
+def force_refresh():
+    """
+    Forget the value of every pin
+
+    The next value written to each pin goes to the hardware even if it
+    is the last value written, for when the pins may have been changed
+    behind our back (they were just set up, or another program used them).
+    """
+    _pin_values.fill(-1)
+
+def write_counts():
+    """
+    Number of pin writes sent to the hardware and skipped so far
+
+    :return: 'written' and 'skipped' counts (a copy)
+    :rtype: dict
+    """
+    return dict(_write_counts)
+
+def _write_pin(i, value):
+    """Write a value to a pin (pwm or on / off), unless it already has it"""
+    if _pin_values[i] == value:
+        _write_counts['skipped'] += 1
+        return
+    _pin_values[i] = value
+    _write_counts['written'] += 1
+    if _PWM_PINS[i]:
+        if _soft_pwm is not None:
+            _soft_pwm.set(i, value)
+        else:
+            wiringpi.softPwmWrite(_GPIO_PINS[i], value)
+    elif _port_writer is not None and _port_writer.on_port[i]:
+        _port_writer.write([i], [value])
+    else:
+        wiringpi.digitalWrite(_GPIO_PINS[i], value)
+
+def _write_levels(channels, levels):
+    """Write on / off levels to channels, for the single_thread pwm engine"""
+    digital_write = wiringpi.digitalWrite
+    if _port_writer is None:
+        for i, level in zip(channels, levels):
+            digital_write(_GPIO_PINS[i], level)
+        return
+    on_port = _port_writer.on_port
+    _port_writer.write([i for i in channels if on_port[i]],
+                       [level for i, level in zip(channels, levels) if on_port[i]])
+    for i, level in zip(channels, levels):
+        if not on_port[i]:
+            digital_write(_GPIO_PINS[i], level)
 
 def set_pins_as_outputs(exportpins):
     '''Set all the configured pins as outputs.'''
@@ -200,7 +291,7 @@ def set_pin_as_output(i, exportpins):
                 subprocess.check_call([_GPIO_UTILITY_PATH, 'export', str(_GPIO_PINS[i]), 'out'])
     else:
         wiringpi.pinMode(_GPIO_PINS[i], _GPIOASOUTPUT)
-        if is_pin_pwm(i):
+        if is_pin_pwm(i) and _PWM_ENGINE != 'single_thread':
             wiringpi.softPwmCreate(_GPIO_PINS[i], 0, _PWM_MAX)
 
 def set_pin_as_input(i, exportpins):
@@ -219,14 +310,15 @@ def turn_off_lights(usealwaysonoff=0):
     for i in range(GPIOLEN):
         if is_pin_pwm(i):
             # No overrides available for pwm mode pins
-            wiringpi.softPwmWrite(_GPIO_PINS[i], _PWM_OFF)
+            _write_pin(i, _PWM_OFF)
             continue
 
         if usealwaysonoff:
             if i + 1 not in _ALWAYS_ON_CHANNELS:
-                wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOINACTIVE)
+                _write_pin(i, _GPIOINACTIVE)
         else:
-            wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOINACTIVE)
+            _write_pin(i, _GPIOINACTIVE)
+    _OUTPUT.frame(_pin_values)
 
 def turn_on_lights(usealwaysonoff=0):
     '''
@@ -237,14 +329,15 @@ def turn_on_lights(usealwaysonoff=0):
     for i in range(GPIOLEN):
         if is_pin_pwm(i):
             # No overrides available for pwm mode pins
-            wiringpi.softPwmWrite(_GPIO_PINS[i], _PWM_ON)
+            _write_pin(i, _PWM_ON)
             continue
 
         if usealwaysonoff:
             if i + 1 not in _ALWAYS_OFF_CHANNELS:
-                wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOACTIVE)
+                _write_pin(i, _GPIOACTIVE)
         else:
-            wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOACTIVE)
+            _write_pin(i, _GPIOACTIVE)
+    _OUTPUT.frame(_pin_values)
 
 def turn_off_light(i, useoverrides=0):
     '''
@@ -254,17 +347,19 @@ def turn_off_light(i, useoverrides=0):
     '''
     if is_pin_pwm(i):
         # No overrides available for pwm mode pins
-        wiringpi.softPwmWrite(_GPIO_PINS[i], _PWM_OFF)
+        _write_pin(i, _PWM_OFF)
+        _OUTPUT.frame(_pin_values)
         return
 
     if useoverrides:
         if i + 1 not in _ALWAYS_ON_CHANNELS:
             if i + 1 not in _INVERTED_CHANNELS:
-                wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOINACTIVE)
+                _write_pin(i, _GPIOINACTIVE)
             else:
-                wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOACTIVE)
+                _write_pin(i, _GPIOACTIVE)
     else:
-        wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOINACTIVE)
+        _write_pin(i, _GPIOINACTIVE)
+    _OUTPUT.frame(_pin_values)
 
 def turn_on_light(i, useoverrides=0, brightness=1.0):
     '''
@@ -281,17 +376,114 @@ def turn_on_light(i, useoverrides=0, brightness=1.0):
             brightness = 0.0
         if brightness > 1.0:
             brightness = 1.0
-        wiringpi.softPwmWrite(_GPIO_PINS[i], int(brightness * _PWM_MAX))
+        _write_pin(i, int(brightness * _PWM_MAX))
+        _OUTPUT.frame(_pin_values)
         return
 
     if useoverrides:
         if i + 1 not in _ALWAYS_OFF_CHANNELS:
             if i + 1 not in _INVERTED_CHANNELS:
-                wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOACTIVE)
+                _write_pin(i, _GPIOACTIVE)
             else:
-                wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOINACTIVE)
+                _write_pin(i, _GPIOINACTIVE)
     else:
-        wiringpi.digitalWrite(_GPIO_PINS[i], _GPIOACTIVE)
+        _write_pin(i, _GPIOACTIVE)
+    _OUTPUT.frame(_pin_values)
+
+class _FrameMap(object):
+    """The pin modes and overrides compiled into masks, for whole frames"""
+
+    def __init__(self):
+        channels = range(1, GPIOLEN + 1)
+        self.pwm = np.array([is_pin_pwm(i) for i in range(GPIOLEN)], dtype=bool)
+        self.inverted = np.array([channel in _INVERTED_CHANNELS for channel in channels])
+        self.always_on = np.array([channel in _ALWAYS_ON_CHANNELS for channel in channels])
+        self.always_off = np.array([channel in _ALWAYS_OFF_CHANNELS for channel in channels])
+        self.always_off &= ~self.always_on
+        self.on_off_values = np.array([_GPIOINACTIVE, _GPIOACTIVE], dtype=FRAME_DTYPE)
+        if _port_writer is not None:
+            self.on_port = np.array(_port_writer.on_port, dtype=bool) & ~self.pwm
+
+_frame_map = None
+
+def compile_frame_map():
+    """Compile the pin modes and overrides for frame_values / write_frame"""
+    global _frame_map
+    _frame_map = _FrameMap()
+
+def frame_values(brightness):
+    """
+    The values written to every pin for rows of channel brightness
+
+    Each row is a frame, one value per pin: the softPwmWrite value of pwm
+    pins, the digitalWrite value of on / off pins (on above 1/2
+    brightness).  This is what turn_on_light / turn_off_light write with
+    overrides, except that always on / off channels are on / off the
+    whole time.
+
+    :param brightness: brightness of each channel from 0 to 1, one row per frame
+    :type brightness: numpy.array
+
+    :return: the pin values, one row per frame
+    :rtype: numpy.array
+    """
+    if _frame_map is None:
+        compile_frame_map()
+    brightness = np.nan_to_num(np.clip(brightness, 0.0, 1.0))
+
+    if _ACTIVE_LOW_MODE:
+        pwm = ((1.0 - brightness) * _PWM_MAX).astype(FRAME_DTYPE)
+    else:
+        pwm = (brightness * _PWM_MAX).astype(FRAME_DTYPE)
+
+    on = (brightness > 0.5) ^ _frame_map.inverted
+    on = (on | _frame_map.always_on) & ~_frame_map.always_off
+    return np.where(_frame_map.pwm, pwm, _frame_map.on_off_values[on.view(np.int8)])
+
+def write_frame(frame):
+    """
+    Write a frame of pin values (see frame_values) to the pins
+
+    Only the pins whose value changed since they were last written are
+    written to.
+    """
+    changed = np.flatnonzero(frame != _pin_values)
+    _write_counts['skipped'] += GPIOLEN - len(changed)
+    if not len(changed):
+        _OUTPUT.frame(_pin_values)
+        return
+    _write_counts['written'] += len(changed)
+    values = frame[changed]
+    _pin_values[changed] = values
+
+    if _port_writer is not None:
+        on_port = _frame_map.on_port[changed]
+        _port_writer.write(changed[on_port].tolist(), values[on_port].tolist())
+        changed = changed[~on_port]
+        values = values[~on_port]
+
+    digital_write = wiringpi.digitalWrite
+    if _soft_pwm is not None:
+        pwm_write = _soft_pwm.set
+        pwm_pins = range(GPIOLEN)
+    else:
+        pwm_write = wiringpi.softPwmWrite
+        pwm_pins = _GPIO_PINS
+    for i, value in zip(changed.tolist(), values.tolist()):
+        if _PWM_PINS[i]:
+            pwm_write(pwm_pins[i], value)
+        else:
+            digital_write(_GPIO_PINS[i], value)
+    _OUTPUT.frame(_pin_values)
+
+def set_brightness(brightness):
+    """
+    Set every light from an array of channel brightness (0 to 1)
+
+    The frame level equivalent of calling turn_on_light / turn_off_light
+    with overrides for every light, see frame_values.
+    """
+    write_frame(frame_values(brightness))
 
 def clean_up(exportpins=_EXPORT_PINS):
     """
@@ -299,17 +491,40 @@ def clean_up(exportpins=_EXPORT_PINS):
 
     Turn off all lights set the pins as inputs
     """
+    global _soft_pwm
+
+    force_refresh()
     turn_off_lights()
+    if _soft_pwm is not None:
+        _soft_pwm.stop()
+        _soft_pwm = None
     set_pins_as_inputs(exportpins)
+    _OUTPUT.flush()
 
 def initialize(exportpins=_EXPORT_PINS):
     '''Set pins as outputs, and start all lights in the off state.'''
+    global _port_writer, _soft_pwm
 
     if not exportpins:
         wiringpi.wiringPiSetup()
 
     enable_device()
     set_pins_as_outputs(exportpins)
+    single_thread_pwm = _PWM_ENGINE == 'single_thread' and any(_PWM_PINS)
+    if _EXPANDER_PORT_WRITES and not exportpins:
+        # the single_thread pwm engine writes through the port writer too
+        _port_writer = expander_ports.PortWriter(
+            wiringpi, _HARDWARE_CONFIG['devices'], _GPIO_PINS,
+            [False] * GPIOLEN if single_thread_pwm else _PWM_PINS)
+    if _soft_pwm is not None:
+        _soft_pwm.stop()
+        _soft_pwm = None
+    if single_thread_pwm:
+        _soft_pwm = soft_pwm.SoftPwm([i for i in range(GPIOLEN) if _PWM_PINS[i]],
+                                     _write_levels, _PWM_MAX, _PWM_FREQUENCY)
+        _soft_pwm.start()
+    compile_frame_map()
+    force_refresh()
     turn_off_lights()
 
 # __________________Main________________
@@ -0,0 +1,190 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Pre-rendered light shows, played back with no analysis at all.
+
+A light show file holds the value written to every pin for every hop of
+a song: the levels of its sync cache normalized by their mean and std
+(as update_lights does), the beat channels flashed, the pwm values
+quantized and the always on / always off / invert overrides applied
+(see hardware_controller.frame_values).  Row n is written to the pins
+when the audio reaches frame n * hop_size, so playing a show is only
+writing one row of bytes per hop, and the lights are exactly the same
+every time the song is played.
+
+Shows use the sync cache file format (see sync_cache.py), with one byte
+(two when pwm_range is over 255) per pin instead of levels, and are kept
+next to the song's sync cache as .<song>.show.  A show is stale, and
+rendered again from the cache, when any of the settings it was rendered
+with (see render_profile) or the audio file changes.
+
+Third party dependencies:
+
+numpy: for the normalization - http://www.numpy.org/
+"""
+import os
+
+import numpy as np
+
+import hardware_controller as hc
+import sync_cache
+
+# Bump when the way shows are rendered changes
+RENDER_VERSION = 1
+
+# The configuration the rendered pin values depend on, besides the
+# configuration the levels depend on (sync_cache.analysis_profile)
+_RENDER_OPTIONS = (('hardware', 'pin_modes'),
+                   ('hardware', 'pwm_range'),
+                   ('hardware', 'active_low_mode'),
+                   ('lightshow', 'always_on_channels'),
+                   ('lightshow', 'always_off_channels'),
+                   ('lightshow', 'invert_channels'),
+                   ('lightshow', 'beat_channels'),
+                   ('lightshow', 'beat_flash_length'))
+
+
+def render_profile(config):
+    """The configuration the rendered show depends on
+
+    :param config: the lightshow configuration (configuration_manager.CONFIG)
+    :type config: ConfigParser
+
+    :return: the settings, by option name
+    :rtype: dict
+    """
+    profile = sync_cache.analysis_profile(config)
+    profile['render'] = RENDER_VERSION
+    for section, option in _RENDER_OPTIONS:
+        if config.has_option(section, option):
+            profile[option] = config.get(section, option).strip()
+    return profile
+
+
+def show_filename(cache_filename):
+    """The light show file kept with a sync cache"""
+    return os.path.splitext(cache_filename)[0] + '.show'
+
+
+def brightness(levels, mean, std):
+    """Brightness of each channel for rows of levels, as update_lights
+
+    Off is at some portion of the std below the mean and full on is at
+    some portion of the std above the mean.
+    """
+    mean = np.asarray(mean)
+    std = np.asarray(std)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip((levels - mean + 0.5 * std) / (1.25 * std), 0.0, 1.0)
+
+
+def beat_flash(beats, hop_seconds, flash_length):
+    """Brightness of the beat channels for each hop, as update_lights
+
+    :param beats: beat flag of each hop (see beat.BeatTracker)
+    :type beats: numpy.array
+
+    :param hop_seconds: length of a hop
+    :type hop_seconds: float
+
+    :param flash_length: seconds a beat flash takes to fade out
+    :type flash_length: float
+
+    :return: the brightness, fading from 1 at each beat
+    :rtype: numpy.array
+    """
+    hops = np.arange(len(beats))
+    last_beat = np.maximum.accumulate(np.where(beats != 0, hops, -1))
+    since = (hops - last_beat) * hop_seconds
+    return np.where(last_beat >= 0, flash_fade(since, flash_length), 0.0)
+
+
+def flash_fade(since, flash_length):
+    """Brightness of a beat flash since seconds after its beat
+
+    :param since: seconds since the beat
+    :type since: float or numpy.array
+
+    :param flash_length: seconds a beat flash takes to fade out
+    :type flash_length: float
+
+    :return: the brightness, from 1 at the beat to 0 after flash_length
+    :rtype: float or numpy.array
+    """
+    flash = 1.0 - since / flash_length if flash_length > 0 else (since == 0) * 1.0
+    return np.clip(flash, 0.0, 1.0)
+
+
+def render(levels, mean, std, hop_seconds, beat_channels=(), flash_length=0.2):
+    """The pin values of every hop of a song
+
+    :param levels: the song's sync cache levels, one row per hop
+    :type levels: numpy.array
+
+    :param mean: mean of each channel's levels
+    :type mean: list
+
+    :param std: standard deviation of each channel's levels
+    :type std: list
+
+    :param hop_seconds: length of a hop
+    :type hop_seconds: float
+
+    :param beat_channels: channels (0 based) flashing on the beat
+    :type beat_channels: list
+
+    :param flash_length: seconds a beat flash takes to fade out
+    :type flash_length: float
+
+    :return: one frame of pin values per hop
+    :rtype: numpy.array
+    """
+    channels = hc.GPIOLEN
+    lights = brightness(np.asarray(levels[:, :channels], dtype=np.float64), mean[:channels],
+                        std[:channels])
+    if len(beat_channels) and levels.shape[1] > channels + 1:
+        flash = beat_flash(np.asarray(levels[:, channels + 1]), hop_seconds, flash_length)
+        lights[:, list(beat_channels)] = flash[:, np.newaxis]
+    return hc.frame_values(lights)
+
+
+def write(filename, frames, parameters, audio=None):
+    """Write a rendered light show
+
+    :param filename: show file name (see show_filename)
+    :type filename: str
+
+    :param frames: one frame of pin values per hop
+    :type frames: numpy.array
+
+    :param parameters: render_profile the show was rendered with
+    :type parameters: dict
+
+    :param audio: audio signature of the song (see sync_cache.locate)
+    :type audio: dict
+    """
+    sync_cache.write(filename, frames, [], [], parameters, audio)
+
+
+def load(filename, parameters, audio):
+    """Open a rendered light show, making sure it is up to date
+
+    :param filename: show file name (see show_filename)
+    :type filename: str
+
+    :param parameters: the current render_profile
+    :type parameters: dict
+
+    :param audio: audio signature of the song (see sync_cache.locate)
+    :type audio: dict
+
+    :return: the show, show.levels holds the frames
+    :rtype: sync_cache.SyncCache
+
+    :raises IOError: when there is no show, or it is incomplete or stale
+    """
+    show = sync_cache.SyncCache(filename)
+    show.check(parameters, audio)
+    if not show.complete:
+        raise IOError("%s is incomplete" % filename)
+    return show
@@ -0,0 +1,169 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Analyze a song ahead of playback, in a background thread.
+
+The first time a song is played there is no sync cache, so its levels
+have to be calculated as it plays, and the mean and std of each channel
+(which the lights are normalized by) are only known once it ends.  A
+LookAhead decodes the song a second time in its own thread and analyzes
+it a block of hops at a time with the batched FFT, running well ahead of
+the audio.  The player takes each hop's levels from it, and the mean and
+std of every level calculated so far, which soon cover most of the song
+instead of being a guess.  The sync cache is written as the levels are
+calculated and completed when the song has been analyzed, even if it
+hasn't finished playing.
+
+numpy and the FFT release the GIL for most of the work, so the analysis
+runs alongside playback even on a single core.
+
+Third party dependencies:
+
+numpy: for the running statistics - http://www.numpy.org/
+"""
+import logging
+import threading
+
+import numpy as np
+
+import sync_cache
+
+
+class LookAhead(threading.Thread):
+    """Background analysis of a song, ahead of playback
+
+    Typical usage:
+
+    look_ahead = LookAhead(musicfile, analysis.SongAnalysis(sample_rate, num_channels),
+                           levels, writer, hc.GPIOLEN, HOP_SIZE)
+    look_ahead.start()
+    ...
+    matrix = look_ahead.row(row)
+    if look_ahead.statistics is not None:
+        std, mean = look_ahead.statistics
+    ...
+    look_ahead.stop()
+    """
+
+    def __init__(self, musicfile, song, levels, writer, num_channels, hop_size, batch_hops=64,
+                 warmup_row=0, min_rows=250):
+        """
+        :param musicfile: the song, opened for this thread only
+        :type musicfile: wave.Wave_read
+
+        :param song: analysis of the song, used by this thread only
+        :type song: analysis.SongAnalysis
+
+        :param levels: the levels of the song, holding any rows already
+            cached, the rest are appended as they are calculated
+        :type levels: sync_cache.LevelBuffer
+
+        :param writer: the song's sync cache, positioned after the rows
+            already cached
+        :type writer: sync_cache.CacheWriter
+
+        :param num_channels: number of light channels (the first columns)
+        :type num_channels: int
+
+        :param hop_size: frames of audio per row of levels
+        :type hop_size: int
+
+        :param batch_hops: hops decoded and analyzed at a time
+        :type batch_hops: int
+
+        :param warmup_row: first row to analyze when resuming a cache (the
+            rows from there up to the cached rows warm up the beat tracker)
+        :type warmup_row: int
+
+        :param min_rows: rows needed before the mean and std are given
+        :type min_rows: int
+        """
+        super(LookAhead, self).__init__(name='look_ahead')
+        self.daemon = True
+        self.levels = levels
+        self.complete = False
+        self._musicfile = musicfile
+        self._song = song
+        self._writer = writer
+        self._num_channels = num_channels
+        self._hop_size = hop_size
+        self._batch_hops = batch_hops
+        self._warmup_row = warmup_row
+        self._min_rows = min_rows
+        self._stopping = threading.Event()
+
+        # running count, sum and sum of squares of each column (only the
+        # levels above 0 for the light channels, as sync_cache.statistics)
+        columns = levels.levels.shape[1]
+        self._count = np.zeros(columns)
+        self._sum = np.zeros(columns)
+        self._squares = np.zeros(columns)
+        self.statistics = None
+        self._add_statistics(levels.levels)
+
+        # rows calculated so far (only changed once they are in the levels)
+        self.rows = len(levels)
+
+    def row(self, row):
+        """The levels of a row, or None if they aren't calculated yet"""
+        if row < self.rows:
+            return self.levels.levels[row]
+        return None
+
+    def stop(self):
+        """Stop analyzing, keeping the rows calculated so far in the cache"""
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        try:
+            self._analyze()
+        except Exception:
+            logging.exception("Look-ahead analysis failed at row %d", self.rows)
+        finally:
+            if not self._writer.closed:
+                self._writer.close()
+
+    def _analyze(self):
+        """Analyze the song a block at a time until it ends or stop is called"""
+        first_row = len(self.levels)
+        row = 0
+        data = self._musicfile.readframes(self._hop_size * self._batch_hops)
+        while data != '' and not self._stopping.is_set():
+            frames = self._song.frames(data)
+            end = row + len(frames)
+            if end > min(self._warmup_row, first_row):
+                levels = self._song.levels(frames)
+                new = levels[max(first_row - row, 0):]
+                if len(new):
+                    self.levels.append(new)
+                    self._writer.append(new)
+                    self._add_statistics(new)
+                    self.rows = len(self.levels)
+            row = end
+            data = self._musicfile.readframes(self._hop_size * self._batch_hops)
+
+        if data == '':
+            std, mean = sync_cache.statistics(self.levels.levels, self._num_channels)
+            self._writer.finalize(std, mean)
+            self.statistics = (std, mean)
+            self.complete = True
+
+    def _add_statistics(self, rows):
+        """Add rows of levels to the running mean and std"""
+        if not len(rows):
+            return
+        counted = np.ones(rows.shape, dtype=bool)
+        counted[:, :self._num_channels] = rows[:, :self._num_channels] > 0
+        values = np.where(counted, rows, 0)
+        self._count += counted.sum(axis=0)
+        self._sum += values.sum(axis=0)
+        self._squares += (values.astype(np.float64) ** 2).sum(axis=0)
+        if len(self.levels) < self._min_rows:
+            return
+        count = np.maximum(self._count, 1)
+        mean = self._sum / count
+        std = np.sqrt(np.maximum(self._squares / count - mean ** 2, 0))
+
+        # replaced in one go, the player reads it while this thread runs
+        self.statistics = (std, mean)
@@ -0,0 +1,246 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Where hardware_controller's pin writes go.
+
+hardware_controller writes the pins through the wiringpi calls of an
+output backend (see BACKENDS), and tells the backend the value of every
+channel after each update of the lights (a frame, a whole set of lights
+turned on or off, or a single light):
+
+wiringpi - the lights, through wiringPi (the WiringPiStub, writing
+           nowhere, when not running on a Raspberry Pi)
+null     - nowhere, even on a Pi, counting the frames written, for dry
+           runs that don't touch the lights
+record   - the lights as wiringpi, and a record of every frame written,
+           with the time it was written, to a recording file, to capture
+           exactly what the lights did in an offline run and measure
+           write rates and frame timing (see tools/recording_stats.py)
+
+A recording is a small binary file:
+
+preamble - the magic 'LSPIRECD', the format version and the header size
+header   - JSON, the time recording started, the channel pins, pin modes
+           and pwm_range, and the dtype of the pin values, padded with
+           spaces to a multiple of 8 bytes
+records  - one per frame, little endian: the seconds since recording
+           started (float64) then the value of every channel (see
+           hardware_controller.frame_values)
+
+Frames are recorded once every channel has been written, as before
+then the state of the lights isn't known, and written to the file
+FLUSH_FRAMES at a time and when the lights are cleaned up.
+
+Third party dependencies:
+
+numpy: for the records - http://www.numpy.org/
+"""
+import atexit
+import json
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+from wiring_pi_stub import WiringPiStub
+
+BACKENDS = ('wiringpi', 'null', 'record')
+
+MAGIC = 'LSPIRECD'
+VERSION = 1
+
+# magic, version, header size (including the preamble)
+_PREAMBLE = struct.Struct('<8sII')
+
+# Frames are written to a recording this many at a time
+FLUSH_FRAMES = 256
+
+
+class OutputBackend(object):
+    """
+    Interface of an output backend
+
+    wiringpi has the wiringpi2 calls hardware_controller writes the pins
+    with, frame is called once with the value of every channel after each
+    update of the lights and flush when the lights are cleaned up.
+    """
+
+    def __init__(self, wiringpi):
+        """
+        :param wiringpi: wiringpi2, or a stand in with its calls
+        :type wiringpi: module
+        """
+        self.wiringpi = wiringpi
+        self.frames = 0
+
+    def frame(self, values):
+        """
+        The value of every channel after an update of the lights
+
+        :param values: the value of each channel, -1 when not written yet
+        :type values: numpy.array
+        """
+        self.frames += 1
+
+    def flush(self):
+        """Write out anything held back"""
+        pass
+
+
+class WiringPiBackend(OutputBackend):
+    """The lights, through wiringPi (or the WiringPiStub off a Pi)"""
+
+    def __init__(self):
+        super(WiringPiBackend, self).__init__(WiringPiStub.import_wiringpi2(logging))
+
+
+class NullBackend(OutputBackend):
+    """Nowhere, even on a Pi"""
+
+    def __init__(self):
+        super(NullBackend, self).__init__(WiringPiStub(logging))
+
+
+class RecordingBackend(OutputBackend):
+    """Records every frame to a file, writing the pins through another backend"""
+
+    def __init__(self, backend, filename, channels):
+        """
+        :param backend: the backend writing the pins
+        :type backend: OutputBackend
+
+        :param filename: the recording, as a time.strftime format, so every
+            run can get its own file
+        :type filename: str
+
+        :param channels: what the channels are, saved in the header (the
+            gpio_pins, pin_modes, pwm_range and dtype of the values)
+        :type channels: dict
+        """
+        super(RecordingBackend, self).__init__(backend.wiringpi)
+        self.filename = None
+        self._backend = backend
+        self._filename = filename
+        self._channels = channels
+        self._records = np.zeros(FLUSH_FRAMES, dtype=record_dtype(channels))
+        self._count = 0
+        self._file = None
+        self._start = None
+        self._closed = False
+
+        # registered now, so it runs after the exit handlers that clean up
+        # the lights (registered later) have recorded turning them off
+        atexit.register(self.close)
+
+    def frame(self, values):
+        super(RecordingBackend, self).frame(values)
+        self._backend.frame(values)
+        if self._closed:
+            return
+        if self._file is None:
+            if (values < 0).any():
+                return
+            self._open()
+        record = self._records[self._count]
+        record['time'] = time.time() - self._start
+        record['values'] = values
+        self._count += 1
+        if self._count == len(self._records):
+            self.flush()
+
+    def flush(self):
+        self._backend.flush()
+        if self._file is None:
+            return
+        self._file.write(self._records[:self._count].tostring())
+        self._file.flush()
+        self._count = 0
+
+    def close(self):
+        """Write out the frames held back and close the recording"""
+        self._closed = True
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def _open(self):
+        """Start a recording"""
+        self._start = time.time()
+        self.filename = time.strftime(self._filename, time.localtime(self._start))
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        header = dict(self._channels)
+        header['start'] = self._start
+        header = json.dumps(header, sort_keys=True)
+        length = _PREAMBLE.size + len(header)
+        header_size = -(-length // 8) * 8
+        self._file = open(self.filename, 'wb')
+        self._file.write(_PREAMBLE.pack(MAGIC, VERSION, header_size))
+        self._file.write(header + ' ' * (header_size - length))
+        logging.info("Recording the lights to " + self.filename)
+
+
+def record_dtype(channels):
+    """numpy dtype of the records of a recording"""
+    return np.dtype([('time', '<f8'),
+                     ('values', np.dtype(channels['dtype']), len(channels['gpio_pins']))])
+
+
+def create(name, record_file=None, channels=None):
+    """
+    The output backend called name (see BACKENDS)
+
+    :param name: the backend
+    :type name: str
+
+    :param record_file: the recording of the record backend, as a
+        time.strftime format
+    :type record_file: str
+
+    :param channels: what the channels are, for the record backend (see
+        RecordingBackend)
+    :type channels: dict
+
+    :return: the backend
+    :rtype: OutputBackend
+
+    :raises ValueError: when there is no backend called name
+    """
+    if name == 'wiringpi':
+        return WiringPiBackend()
+    if name == 'null':
+        return NullBackend()
+    if name == 'record':
+        return RecordingBackend(WiringPiBackend(), record_file, channels)
+    raise ValueError("Unknown output backend '%s', it is one of %s" % (name, ', '.join(BACKENDS)))
+
+
+def read_recording(filename):
+    """
+    Read a recording
+
+    :param filename: the recording
+    :type filename: str
+
+    :return: the header, and the records (time and values of each frame)
+    :rtype: tuple
+
+    :raises IOError: when the file isn't a recording
+    """
+    with open(filename, 'rb') as recording:
+        data = recording.read()
+    if len(data) < _PREAMBLE.size:
+        raise IOError("%s is not a recording" % filename)
+    magic, version, header_size = _PREAMBLE.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise IOError("%s is not a version %d recording" % (filename, VERSION))
+    header = json.loads(data[_PREAMBLE.size:header_size])
+    dtype = record_dtype(header)
+    frames = (len(data) - header_size) // dtype.itemsize
+    records = np.frombuffer(data, dtype=dtype, count=frames, offset=header_size)
+    return header, records
@@ -0,0 +1,241 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Pipelined song playback: decode, audio output and lights in step.
+
+Playing a song used to decode a hop of audio, write it to the sound card,
+analyze it and update the lights one after the other, so a slow decode
+(an mp3 on a first play) or a slow light update starved the sound card
+and the music stuttered.  A Playback runs each step in its own stage:
+
+decoder - a thread reading hops of audio from the song into a PcmRing
+writer  - a thread writing the hops in the ring to the sound card (or fm
+          pipe), counting the hops played
+lights  - the caller, woken each time the writer has played more audio,
+          updating the lights for the latest hop played
+
+The ring holds a fixed number of hops in a preallocated array, so the
+stages pass audio around without allocating anything per hop.  The
+decoder runs up to a ring's worth of audio ahead of the sound card.  A
+hop stays in the ring until both the writer and the lights are done
+with it, and the lights get every hop (to keep their analysis window
+up to date) but only update for the latest one, so lights that fall
+behind catch up with the audio instead of slowing it down.
+
+Third party dependencies:
+
+numpy: for the ring buffer - http://www.numpy.org/
+"""
+import logging
+import threading
+
+import numpy as np
+
+
+class PcmRing(object):
+    """Bounded ring of hops of 16 bit audio, one producer, two readers
+
+    Hops are put by the decoder, played by the writer and then released
+    by the lights.  put blocks while the ring is full, the readers block
+    until there is something for them.
+    """
+
+    def __init__(self, capacity, hop_size, num_channels):
+        self._slots = np.zeros((capacity, hop_size * num_channels), dtype=np.int16)
+        self._lengths = np.zeros(capacity, dtype=int)
+        self._slot_bytes = self._slots.shape[1] * self._slots.itemsize
+        self.capacity = capacity
+        self.decoded = 0
+        self.played = 0
+        self.released = 0
+        self.ended = False
+        self.stopped = False
+        self._condition = threading.Condition()
+
+    def put(self, data):
+        """Add a hop of audio (as read from the song), waiting for room
+
+        :return: False if the ring was stopped
+        :rtype: bool
+        """
+        with self._condition:
+            while self.decoded - self.released >= self.capacity and not self.stopped:
+                self._condition.wait()
+            if self.stopped:
+                return False
+            slot = self.decoded % self.capacity
+            samples = np.frombuffer(data, dtype=np.int16)
+        self._slots[slot, :len(samples)] = samples
+        with self._condition:
+            self._lengths[slot] = len(data)
+            self.decoded += 1
+            self._condition.notify_all()
+        return True
+
+    def end(self):
+        """No more hops will be put"""
+        with self._condition:
+            self.ended = True
+            self._condition.notify_all()
+
+    def stop(self):
+        """Stop all the stages, waking any that are waiting"""
+        with self._condition:
+            self.stopped = True
+            self._condition.notify_all()
+
+    def next_to_play(self):
+        """Wait for the next hop to play
+
+        :return: the hop's audio (a buffer into the ring, valid until
+            played is called), or None at the end or when stopped
+        :rtype: buffer
+        """
+        with self._condition:
+            while self.played >= self.decoded and not self.ended and not self.stopped:
+                self._condition.wait()
+            if self.stopped or self.played >= self.decoded:
+                return None
+            slot = self.played % self.capacity
+            return buffer(self._slots, slot * self._slot_bytes, int(self._lengths[slot]))
+
+    def play(self):
+        """The hop from next_to_play has been written to the sound card"""
+        with self._condition:
+            self.played += 1
+            self._condition.notify_all()
+
+    def wait_played(self, row):
+        """Wait until hop row has been played (or the end, or stopped)
+
+        :return: the number of hops played so far
+        :rtype: int
+        """
+        with self._condition:
+            while (self.played <= row and not self.stopped
+                   and not (self.ended and self.played >= self.decoded)):
+                self._condition.wait()
+            return self.played
+
+    def hop(self, row):
+        """The audio of a hop that hasn't been released yet
+
+        :return: the interleaved samples (a view into the ring)
+        :rtype: numpy.array
+        """
+        slot = row % self.capacity
+        return self._slots[slot, :self._lengths[slot] // self._slots.itemsize]
+
+    def release(self, rows):
+        """The lights are done with the hops before rows, they can be reused"""
+        with self._condition:
+            self.released = max(self.released, min(rows, self.played))
+            self._condition.notify_all()
+
+
+class Playback(object):
+    """Play a song through the decoder and writer stages
+
+    Typical usage:
+
+    playback = Playback(musicfile, output.write, HOP_SIZE, num_channels)
+    playback.start()
+    row = 0
+    while playback.wait(row):
+        for hop in range(row, playback.played):
+            ring.push(playback.hop(hop))
+        playback.release(playback.played)
+        row = playback.played
+        update_lights(...)     # for hop row - 1, the latest one played
+    playback.stop()
+    """
+
+    def __init__(self, musicfile, write, hop_size, num_channels, capacity=32):
+        """
+        :param musicfile: the song to play
+        :type musicfile: wave.Wave_read
+
+        :param write: writes a hop of audio to the sound card (or fm pipe),
+            returning once it has been taken
+        :type write: function
+
+        :param hop_size: frames of audio per hop
+        :type hop_size: int
+
+        :param num_channels: interleaved channels of the song
+        :type num_channels: int
+
+        :param capacity: hops the decoder may run ahead of the lights
+        :type capacity: int
+        """
+        self._musicfile = musicfile
+        self._write = write
+        self._hop_size = hop_size
+        self._ring = PcmRing(capacity, hop_size, num_channels)
+        self._threads = [threading.Thread(target=self._decode, name='decoder'),
+                         threading.Thread(target=self._play, name='audio_writer')]
+        for thread in self._threads:
+            thread.daemon = True
+
+    @property
+    def played(self):
+        """Number of hops written to the sound card so far"""
+        return self._ring.played
+
+    @property
+    def finished(self):
+        """Has the whole song been played (as opposed to stopped)"""
+        ring = self._ring
+        return ring.ended and ring.played >= ring.decoded and not ring.stopped
+
+    def start(self):
+        """Start decoding and playing"""
+        for thread in self._threads:
+            thread.start()
+
+    def wait(self, row):
+        """Wait until hop row has been played
+
+        :return: False once the song has ended or playback was stopped
+        :rtype: bool
+        """
+        return self._ring.wait_played(row) > row
+
+    def hop(self, row):
+        """The audio of a played hop that hasn't been released yet"""
+        return self._ring.hop(row)
+
+    def release(self, rows):
+        """Done with the hops before rows"""
+        self._ring.release(rows)
+
+    def stop(self):
+        """Stop playing, and wait for the stages to finish"""
+        self._ring.stop()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
+
+    def _decode(self):
+        """Decoder stage"""
+        try:
+            data = self._musicfile.readframes(self._hop_size)
+            while data != '' and self._ring.put(data):
+                data = self._musicfile.readframes(self._hop_size)
+        except Exception:
+            logging.exception("Decoding failed")
+            self._ring.stop()
+        finally:
+            self._ring.end()
+
+    def _play(self):
+        """Audio writer stage"""
+        try:
+            data = self._ring.next_to_play()
+            while data is not None:
+                self._write(data)
+                self._ring.play()
+                data = self._ring.next_to_play()
+        except Exception:
+            logging.exception("Writing audio failed")
+            self._ring.stop()
@@ -0,0 +1,124 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Software pwm for all the pwm channels from a single thread.
+
+wiringPi's softPwmCreate starts a real time priority thread for every
+pwm pin, each waking up twice a period, so 8 to 16 pwm channels keep a
+Pi's cpu busy and the scheduling jitter reaches the audio.  A SoftPwm
+drives every pwm channel from one timing loop instead.  It keeps a duty
+value per channel (0 to pwm_range), and each period it turns all the
+channels with a duty on at once, then turns off together every channel
+with the same duty when its time comes, so a period is one write of the
+channels turning on plus one write per distinct duty.  The writes are
+of a list of channels, so on port expanders each one is a single port
+register write (see expander_ports.py).
+
+Channels with a duty of 0 or pwm_range don't pulse, they are written
+once when their duty changes.
+"""
+import threading
+import time
+
+
+class SoftPwm(threading.Thread):
+    """Software pwm of a set of channels, from a single thread
+
+    Typical usage:
+
+    pwm = SoftPwm(pwm_channels, write_levels, 100, 100.0)
+    pwm.start()
+    pwm.set(channel, 25)
+    ...
+    pwm.stop()
+    """
+
+    def __init__(self, channels, write, pwm_range, frequency):
+        """
+        :param channels: the pwm channels
+        :type channels: list
+
+        :param write: writes on / off levels to channels, called with a
+            list of channels and a list of levels (1 or 0)
+        :type write: function
+
+        :param pwm_range: the duty of a channel that is always on
+        :type pwm_range: int
+
+        :param frequency: pwm periods per second
+        :type frequency: float
+        """
+        super(SoftPwm, self).__init__(name='soft_pwm')
+        self.daemon = True
+        self.channels = list(channels)
+        self.pwm_range = pwm_range
+        self.period = 1.0 / frequency
+        self.periods = 0
+        self.overruns = 0
+        self._write = write
+        self._duty = dict((channel, 0) for channel in self.channels)
+        self._version = 0
+        self._stopping = threading.Event()
+
+    def set(self, channel, duty):
+        """Set the duty (0 to pwm_range) of a channel, from the next period"""
+        self._duty[channel] = min(max(int(duty), 0), self.pwm_range)
+        self._version += 1
+
+    def stop(self):
+        """Stop pulsing, leaving each channel on if its duty is over half"""
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+        levels = [int(self._duty[channel] * 2 > self.pwm_range) for channel in self.channels]
+        self._write(self.channels, levels)
+
+    def _schedule(self):
+        """
+        The writes of a period for the current duties
+
+        :return: the channels turned on at the start of a period, the
+            channels turned off at each time (seconds into the period),
+            and the channels that are always on and always off
+        :rtype: tuple
+        """
+        duty = dict(self._duty)
+        pulsing = [channel for channel in self.channels if 0 < duty[channel] < self.pwm_range]
+        edges = dict()
+        for channel in pulsing:
+            edges.setdefault(duty[channel], []).append(channel)
+        offsets = [(value * self.period / self.pwm_range, edges[value])
+                   for value in sorted(edges)]
+        always_on = [channel for channel in self.channels if duty[channel] >= self.pwm_range]
+        always_off = [channel for channel in self.channels if duty[channel] <= 0]
+        return pulsing, offsets, always_on, always_off
+
+    def run(self):
+        version = None
+        start = time.time()
+        while not self._stopping.is_set():
+            if version != self._version:
+                version = self._version
+                pulsing, offsets, always_on, always_off = self._schedule()
+                if always_on:
+                    self._write(always_on, [1] * len(always_on))
+                if always_off:
+                    self._write(always_off, [0] * len(always_off))
+
+            if pulsing:
+                self._write(pulsing, [1] * len(pulsing))
+                for offset, channels in offsets:
+                    delay = start + offset - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self._write(channels, [0] * len(channels))
+
+            self.periods += 1
+            start += self.period
+            delay = start - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.period:
+                # More than a period behind, start again from now
+                self.overruns += 1
+                start = time.time()
@@ -0,0 +1,792 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Read and write the sync cache files holding the analyzed levels of a song.
+
+A sync cache is a small binary file:
+
+preamble - the magic 'LSPISYNC', the format version, the header size, the
+           number of valid rows and whether the cache is complete
+header   - JSON, the analysis parameters and their fingerprint, the size
+           and modification time of the audio file, the std and mean of
+           each column (once complete), and the dtype and columns of the
+           levels, padded with spaces to a whole number of pages
+levels   - one row of levels per hop of audio, little endian, row after row
+
+(much like numpy's own .npy files).  The levels are page aligned, so
+playback memory maps them and only the rows actually played are read
+from the SD card, instead of parsing the whole cache before the song
+starts.
+
+A complete cache can instead be stored compact (see ENCODINGS): the
+levels quantized to float16, or to uint8 with a scale and offset per
+column, and zlib compressed.  A compact cache is decoded in one go when
+it is opened, and is a fraction of the size (a 4 minute song with 64
+channels is about 250 KB as uint8 instead of 2.6 MB), for keeping the
+caches of a whole season's playlist on the SD card.
+
+While a song plays for the first time its cache is written as a journal
+(see CacheWriter): rows are appended as they are calculated and the count
+of valid rows is only updated once they are written, so a cache cut short
+by skipping the song, stopping the lightshow or a crash keeps every row
+written so far, and the next play picks up where it stopped.
+
+A cache is stale, and gets regenerated, when any of the configuration
+that changes the levels (see analysis_profile) or the audio file itself
+has changed since it was written.
+
+Caches are kept next to each song (as .<song>.sync), or all together in
+a CacheDirectory named after a hash of the song's audio, which works with
+read-only and shared (NFS) music folders and keeps the caches to a size
+limit.
+
+Third party dependencies:
+
+numpy: for the level arrays - http://www.numpy.org/
+"""
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = 'LSPISYNC'
+VERSION = 2
+
+# magic, version, header size (including the preamble)
+_PREAMBLE = struct.Struct('<8sII')
+
+# valid rows, complete - updated in place as the cache is written
+_PROGRESS = struct.Struct('<II')
+
+# Rows calculated while playing are written to the cache this many at a time
+FLUSH_ROWS = 64
+
+# The header is padded to a multiple of this
+_HEADER_ALIGNMENT = 4096
+
+# Bump when the layout or meaning of the cached level columns changes
+LEVELS_VERSION = 2
+
+# How the levels of a complete cache are stored:
+#   raw     - as calculated (analysis_dtype), memory mapped when played
+#   float16 - half precision difference from the column's mean level
+#             (NaN for levels of exactly 0), zlib compressed
+#   uint8   - per column scale and offset, zlib compressed.  0 is kept for
+#             levels of exactly 0 (no power, see fft), 1 - 255 evenly span
+#             the rest of the column's values
+ENCODINGS = ('raw', 'float16', 'uint8')
+
+# The configuration the cached levels depend on
+_PROFILE_OPTIONS = (('hardware', 'gpio_pins'),
+                    ('audio_processing', 'min_frequency'),
+                    ('audio_processing', 'max_frequency'),
+                    ('audio_processing', 'custom_channel_mapping'),
+                    ('audio_processing', 'custom_channel_frequencies'),
+                    ('audio_processing', 'custom_channel_bands'),
+                    ('audio_processing', 'chunk_size'),
+                    ('audio_processing', 'hop_size'),
+                    ('audio_processing', 'band_shape'),
+                    ('audio_processing', 'channel_mode'),
+                    ('audio_processing', 'analysis_dtype'))
+
+
+class StaleCacheError(IOError):
+    """A sync cache generated with other analysis settings or other audio"""
+
+
+class SyncCache(object):
+    """A sync cache opened for reading
+
+    The levels are memory mapped, rows are read from the file as they are
+    used.  An incomplete cache (complete is False) has no std / mean yet
+    and its levels stop where writing it stopped, see resume.
+
+    Typical usage:
+
+    cache = SyncCache(cache_filename)
+    cache.check(parameters, audio_signature(song_filename))
+    matrix = cache.levels[row]
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as cache_file:
+            preamble = cache_file.read(_PREAMBLE.size)
+            if len(preamble) < _PREAMBLE.size:
+                raise IOError("%s is not a sync cache" % filename)
+            magic, version, header_size = _PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise IOError("%s is not a sync cache" % filename)
+            if version != VERSION:
+                raise IOError("%s is a version %d sync cache, expected version %d"
+                              % (filename, version, VERSION))
+            rows, complete = _PROGRESS.unpack(cache_file.read(_PROGRESS.size))
+            try:
+                header = json.loads(cache_file.read(header_size - _PREAMBLE.size
+                                                    - _PROGRESS.size))
+            except ValueError as error:
+                raise IOError("%s has a corrupt header: %s" % (filename, error))
+
+        self.filename = filename
+        self.header = header
+        self.header_size = header_size
+        self.parameters = header['parameters']
+        self.fingerprint = header.get('fingerprint')
+        self.audio = header.get('audio')
+
+        self.encoding = header.get('encoding', 'raw')
+        if self.encoding != 'raw' and complete:
+            # a compact cache is always complete, decode it all now
+            self.complete = True
+            self.std = np.array(header['std'])
+            self.mean = np.array(header['mean'])
+            with open(filename, 'rb') as cache_file:
+                cache_file.seek(header_size)
+                self.levels = decode(header, cache_file.read(), rows)
+            return
+
+        # Only trust the rows that made it to the disk
+        row_size = header['columns'] * np.dtype(header['dtype']).itemsize
+        written = (os.path.getsize(filename) - header_size) // row_size
+        self.complete = bool(complete) and written >= rows
+        rows = min(rows, written)
+        shape = (rows, header['columns'])
+
+        self.std = np.array(header['std']) if self.complete else None
+        self.mean = np.array(header['mean']) if self.complete else None
+
+        if rows:
+            self.levels = np.memmap(filename, dtype=header['dtype'], mode='r',
+                                    offset=header_size, shape=shape)
+        else:
+            self.levels = np.empty(shape, dtype=header['dtype'])
+
+    def __len__(self):
+        return len(self.levels)
+
+    def check(self, parameters, audio):
+        """Make sure the cache is not stale
+
+        :param parameters: the current analysis_profile
+        :type parameters: dict
+
+        :param audio: the current audio_signature of the song
+        :type audio: dict
+
+        :raises StaleCacheError: when the cache was generated with other
+            settings (its fingerprint differs) or audio (its audio_signature
+            differs)
+        """
+        if self.fingerprint != fingerprint(parameters):
+            changed = sorted(key for key in set(parameters) | set(self.parameters)
+                             if parameters.get(key) != self.parameters.get(key))
+            raise StaleCacheError("analysis settings fingerprint changed: " + ', '.join(changed))
+        if self.audio != audio:
+            raise StaleCacheError("audio signature changed, the song was modified since the "
+                                  "cache was generated")
+
+
+class CacheWriter(object):
+    """Writes a sync cache a few rows at a time, as a journal
+
+    Rows are appended to the end of the cache file flush_rows at a time,
+    and the count of valid rows in the preamble is updated after they are
+    written, so a reader (or the next play, see resume) only ever sees
+    whole rows.  finalize adds the std / mean and marks the cache
+    complete, a cache closed without finalizing stays incomplete.  A
+    cache created with a compact encoding is written raw and only
+    encoded when finalized.
+
+    Use create or resume to get a CacheWriter.
+
+    Typical usage:
+
+    writer = sync_cache.create(cache_filename, columns, dtype, parameters, audio)
+    writer.append(matrix)
+    ...
+    writer.finalize(std, mean)
+    """
+
+    def __init__(self, cache_file, header, header_size, rows, flush_rows=FLUSH_ROWS):
+        self._file = cache_file
+        self._header = header
+        self._header_size = header_size
+        self._dtype = np.dtype(header['dtype'])
+        self._row_size = header['columns'] * self._dtype.itemsize
+        self._flush_rows = flush_rows
+        self._pending = []
+        self._pending_rows = 0
+        self.rows = rows
+
+    @property
+    def closed(self):
+        """Has the cache been finalized or closed"""
+        return self._file.closed
+
+    def append(self, rows):
+        """Append a row, or a block of rows, of levels"""
+        rows = np.asarray(rows, dtype=self._dtype)
+        self._pending.append(rows.tostring())
+        self._pending_rows += 1 if rows.ndim == 1 else len(rows)
+        if self._pending_rows >= self._flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Write the pending rows, then count them as valid"""
+        if not self._pending or self._file.closed:
+            return
+        self._file.seek(self._header_size + self.rows * self._row_size)
+        self._file.write(''.join(self._pending))
+        self._file.flush()
+        self.rows += self._pending_rows
+        self._pending = []
+        self._pending_rows = 0
+        self._write_progress(False)
+
+    def finalize(self, std, mean):
+        """Write the std and mean of each column and mark the cache complete
+
+        :param std: standard deviation of each column of levels
+        :type std: list
+
+        :param mean: mean of each column of levels
+        :type mean: list
+        """
+        self.flush()
+        self._header['std'] = [float(value) for value in std]
+        self._header['mean'] = [float(value) for value in mean]
+
+        if self._header.get('encoding', 'raw') != 'raw':
+            self._file.close()
+            levels = np.memmap(self._file.name, dtype=self._dtype, mode='r',
+                               offset=self._header_size,
+                               shape=(self.rows, self._header['columns']))
+            _write_compact(self._file.name, self._header, levels)
+            del levels
+            return
+
+        self._file.seek(_PREAMBLE.size + _PROGRESS.size)
+        self._file.write(_encode_header(self._header, self._header_size))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._write_progress(True)
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def close(self):
+        """Write the pending rows and close the cache, leaving it incomplete"""
+        self.flush()
+        self._file.close()
+
+    def _write_progress(self, complete):
+        """Update the valid row count and complete flag in place"""
+        self._file.seek(_PREAMBLE.size)
+        self._file.write(_PROGRESS.pack(self.rows, complete))
+        self._file.flush()
+
+
+def create(filename, columns, dtype, parameters, audio=None, encoding='raw'):
+    """Start writing a new, empty sync cache
+
+    :param filename: cache file name
+    :type filename: str
+
+    :param columns: number of columns of levels
+    :type columns: int
+
+    :param dtype: dtype of the levels
+    :type dtype: str
+
+    :param parameters: analysis_profile the levels are calculated with
+    :type parameters: dict
+
+    :param audio: audio_signature of the song the levels are calculated for
+    :type audio: dict
+
+    :param encoding: how the levels are stored once complete, see ENCODINGS
+    :type encoding: str
+
+    :return: writer to append the levels with
+    :rtype: CacheWriter
+    """
+    header = _new_header(columns, dtype, parameters, audio, encoding)
+
+    # leave room in the header for the std and mean of every column
+    length = _PREAMBLE.size + _PROGRESS.size + len(json.dumps(header)) + 2 * columns * 26
+    header_size = -(-length // _HEADER_ALIGNMENT) * _HEADER_ALIGNMENT
+
+    cache_file = open(filename, 'wb')
+    cache_file.write(_PREAMBLE.pack(MAGIC, VERSION, header_size))
+    cache_file.write(_PROGRESS.pack(0, False))
+    cache_file.write(_encode_header(header, header_size))
+    cache_file.flush()
+    return CacheWriter(cache_file, header, header_size, 0)
+
+
+def _new_header(columns, dtype, parameters, audio, encoding):
+    """The header of a new cache"""
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown sync cache encoding '%s', expected one of %s"
+                         % (encoding, ', '.join(ENCODINGS)))
+    return {'parameters': parameters,
+            'fingerprint': fingerprint(parameters),
+            'audio': audio,
+            'std': None,
+            'mean': None,
+            'dtype': np.dtype(dtype).newbyteorder('<').str,
+            'columns': columns,
+            'encoding': encoding}
+
+
+def encode(levels, encoding):
+    """Quantize and compress levels
+
+    :param levels: one row of levels per hop
+    :type levels: numpy.array
+
+    :param encoding: 'float16' or 'uint8', see ENCODINGS
+    :type encoding: str
+
+    :return: the header fields needed to decode the levels, and the
+        compressed levels
+    :rtype: tuple
+    """
+    levels = np.asarray(levels, dtype=np.float64)
+    nonzero = levels != 0
+    present = nonzero.any(axis=0)
+    count = np.maximum(nonzero.sum(axis=0), 1)
+    fields = {'compression': 'zlib'}
+    if encoding == 'float16':
+        # the difference from the mean keeps the precision where the levels are
+        offset = np.where(nonzero, levels, 0).sum(axis=0) / count
+        quantized = np.where(nonzero, levels - offset, np.nan).astype('<f2')
+    elif encoding == 'uint8':
+        offset = np.where(present, np.where(nonzero, levels, np.inf).min(axis=0), 0.0)
+        top = np.where(present, np.where(nonzero, levels, -np.inf).max(axis=0), 0.0)
+        scale = (top - offset) / 254.0
+        steps = np.rint((levels - offset) / np.where(scale > 0, scale, 1.0))
+        quantized = np.where(nonzero, 1 + steps, 0).astype(np.uint8)
+        fields['scale'] = scale.tolist()
+    else:
+        raise ValueError("Can't encode levels as '%s'" % encoding)
+    fields['offset'] = offset.tolist()
+
+    # column after column, each column changes less than each row
+    return fields, zlib.compress(np.ascontiguousarray(quantized.T).tostring(), 9)
+
+
+def decode(header, data, rows):
+    """Decompress and dequantize the levels of a compact cache
+
+    :param header: the cache header, with the fields from encode
+    :type header: dict
+
+    :param data: the compressed levels
+    :type data: str
+
+    :param rows: number of rows of levels
+    :type rows: int
+
+    :return: the levels, in the cache's dtype
+    :rtype: numpy.array
+
+    :raises IOError: when the levels are corrupt
+    """
+    encoding = header['encoding']
+    stored = {'float16': '<f2', 'uint8': np.uint8}.get(encoding)
+    if stored is None or header.get('compression') != 'zlib':
+        raise IOError("unknown sync cache encoding '%s'" % encoding)
+    try:
+        quantized = np.frombuffer(zlib.decompress(data), dtype=stored)
+        quantized = quantized.reshape(header['columns'], rows).T
+    except (zlib.error, ValueError) as error:
+        raise IOError("sync cache levels are corrupt: %s" % error)
+
+    offset = np.array(header['offset'], dtype=header['dtype'])
+    quantized = np.ascontiguousarray(quantized)
+    if encoding == 'float16':
+        levels = offset + quantized.astype(header['dtype'])
+        levels[np.isnan(quantized)] = 0
+        return levels
+    scale = np.array(header['scale'], dtype=header['dtype'])
+    levels = offset + (quantized.astype(header['dtype']) - 1) * scale
+    levels[quantized == 0] = 0
+    return levels
+
+
+def _write_compact(filename, header, levels):
+    """Write a complete, compact cache (renamed over filename when done)"""
+    fields, data = encode(levels, header['encoding'])
+    header = dict(header, **fields)
+    length = _PREAMBLE.size + _PROGRESS.size + len(json.dumps(header, sort_keys=True))
+    header_size = -(-length // 8) * 8
+
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as cache_file:
+        cache_file.write(_PREAMBLE.pack(MAGIC, VERSION, header_size))
+        cache_file.write(_PROGRESS.pack(len(levels), True))
+        cache_file.write(_encode_header(header, header_size))
+        cache_file.write(data)
+        cache_file.flush()
+        os.fsync(cache_file.fileno())
+    os.rename(temporary, filename)
+
+
+def resume(cache):
+    """Carry on writing a cache after its last valid row
+
+    Anything after the last valid row (a row cut off by a crash) is
+    dropped.  The cache is incomplete again until finalized.
+
+    :param cache: the cache to extend
+    :type cache: SyncCache
+
+    :return: writer to append the rest of the levels with
+    :rtype: CacheWriter
+    """
+    cache_file = open(cache.filename, 'r+b')
+    writer = CacheWriter(cache_file, cache.header, cache.header_size, len(cache))
+    cache_file.truncate(cache.header_size + len(cache) * writer._row_size)
+    writer._write_progress(False)
+    return writer
+
+
+def _encode_header(header, header_size):
+    """The JSON header, padded to fill the space reserved for it"""
+    encoded = json.dumps(header, sort_keys=True)
+    space = header_size - _PREAMBLE.size - _PROGRESS.size
+    if len(encoded) > space:
+        raise IOError("sync cache header does not fit in %d bytes" % space)
+    return encoded.ljust(space)
+
+
+class LevelBuffer(object):
+    """Growable array of level rows, for calculating a cache a hop at a time
+
+    Rows are appended into a preallocated array, which doubles in size
+    when it fills up, so appending costs the same at the end of an hour
+    long mix as at the start (np.vstack copies every row so far on each
+    append).  Sizing it with the expected number of rows up front avoids
+    growing it at all.
+
+    Typical usage:
+
+    buffer = LevelBuffer(columns, dtype, expected_rows(musicfile.getnframes(), HOP_SIZE))
+    buffer.append(matrix)
+    sync_cache.write(cache_filename, buffer.levels, ...)
+    """
+
+    def __init__(self, columns, dtype='float64', capacity=0):
+        self._data = np.empty((max(capacity, 16), columns), dtype=dtype)
+        self._rows = 0
+
+    def __len__(self):
+        return self._rows
+
+    @property
+    def levels(self):
+        """The rows appended so far (a view, not a copy)"""
+        return self._data[:self._rows]
+
+    def append(self, rows):
+        """Append a row, or a block of rows, of levels"""
+        rows = np.asarray(rows)
+        count = 1 if rows.ndim == 1 else len(rows)
+        end = self._rows + count
+        if end > len(self._data):
+            grown = np.empty((max(end, 2 * len(self._data)), self._data.shape[1]),
+                             dtype=self._data.dtype)
+            grown[:self._rows] = self.levels
+            self._data = grown
+        self._data[self._rows:end] = rows
+        self._rows = end
+
+
+def expected_rows(num_frames, hop_size):
+    """Number of level rows for a song of num_frames frames"""
+    return -(-num_frames // hop_size)
+
+
+def analysis_profile(config):
+    """The configuration the cached levels depend on
+
+    :param config: the lightshow configuration (configuration_manager.CONFIG)
+    :type config: ConfigParser
+
+    :return: the settings, by option name
+    :rtype: dict
+    """
+    profile = {'levels': LEVELS_VERSION}
+    for section, option in _PROFILE_OPTIONS:
+        if config.has_option(section, option):
+            profile[option] = config.get(section, option).strip()
+    return profile
+
+
+def fingerprint(parameters):
+    """A short hash identifying a set of analysis parameters"""
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True)).hexdigest()
+
+
+def audio_signature(song_filename):
+    """Size and modification time of an audio file, to notice it changing"""
+    status = os.stat(song_filename)
+    return {'size': status.st_size, 'mtime': int(status.st_mtime)}
+
+
+def content_hash(song_filename):
+    """SHA-1 of the contents of an audio file"""
+    digest = hashlib.sha1()
+    with open(song_filename, 'rb') as song_file:
+        for block in iter(lambda: song_file.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_directory(config, home_dir):
+    """The CacheDirectory configured by sync_cache_dir, if any
+
+    :param config: the lightshow configuration (configuration_manager.CONFIG)
+    :type config: ConfigParser
+
+    :param home_dir: SYNCHRONIZED_LIGHTS_HOME
+    :type home_dir: str
+
+    :return: the central cache directory, or None to keep caches next to
+        each song
+    :rtype: CacheDirectory
+    """
+    if not config.has_option('audio_processing', 'sync_cache_dir'):
+        return None
+    path = config.get('audio_processing', 'sync_cache_dir').strip()
+    if not path:
+        return None
+    path = os.path.expanduser(path.replace('$SYNCHRONIZED_LIGHTS_HOME', home_dir))
+    max_bytes = int(float(config.get('audio_processing', 'sync_cache_size')) * 1024 * 1024)
+    return CacheDirectory(path, max_bytes)
+
+
+def locate(song_filename, directory=None):
+    """The cache file name and audio_signature to use for a song
+
+    :param song_filename: audio file
+    :type song_filename: str
+
+    :param directory: central cache directory, or None to keep the cache
+        next to the song
+    :type directory: CacheDirectory
+
+    :return: cache file name and audio signature
+    :rtype: tuple
+    """
+    if directory is not None:
+        return directory.lookup(song_filename)
+    cache_filename = \
+        os.path.dirname(song_filename) + "/." + os.path.basename(song_filename) + ".sync"
+    return cache_filename, audio_signature(song_filename)
+
+
+class CacheDirectory(object):
+    """A directory of sync caches named by the hash of the song's audio
+
+    The same song has the same cache wherever it is played from, and the
+    music folders are only ever read.  An index (index.json) remembers the
+    hash of each song played, so a song's audio is only hashed again when
+    its size or modification time changes, and when each cache was last
+    used and how big it is.  Once the caches go over max_bytes the least
+    recently used are removed.
+
+    Typical usage:
+
+    directory = CacheDirectory('/home/pi/.sync_cache', 200 * 1024 * 1024)
+    cache_filename, audio = directory.lookup(song_filename)
+    ... read or write the cache ...
+    directory.store(cache_filename)
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._index_filename = os.path.join(path, 'index.json')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def lookup(self, song_filename):
+        """The cache file name and audio_signature for a song
+
+        Marks the song's cache as just used.
+
+        :param song_filename: audio file
+        :type song_filename: str
+
+        :return: cache file name and audio signature
+        :rtype: tuple
+        """
+        song_filename = os.path.abspath(song_filename)
+        status = os.stat(song_filename)
+        signature = [status.st_size, int(status.st_mtime)]
+
+        with self._locked_index() as index:
+            known = index['songs'].get(song_filename)
+            if known is not None and known[:2] == signature:
+                digest = known[2]
+            else:
+                digest = content_hash(song_filename)
+                index['songs'][song_filename] = signature + [digest]
+            entry = index['caches'].setdefault(digest, {'size': 0})
+            entry['used'] = time.time()
+
+        return os.path.join(self.path, digest + '.sync'), {'sha1': digest}
+
+    def store(self, cache_filename):
+        """Record the size of a cache written to the directory, and remove
+        the least recently used caches if over max_bytes
+
+        Files kept with the cache (<hash>.show light shows) count towards
+        its size, and are removed with it.
+
+        :param cache_filename: cache file name returned by lookup
+        :type cache_filename: str
+        """
+        digest = os.path.basename(cache_filename)[:-len('.sync')]
+        with self._locked_index() as index:
+            entry = index['caches'].setdefault(digest, {})
+            entry['size'] = sum(os.path.getsize(filename) for filename in self._files(digest))
+            entry['used'] = time.time()
+
+            total = sum(cache['size'] for cache in index['caches'].values())
+            for old in sorted(index['caches'], key=lambda key: index['caches'][key]['used']):
+                if total <= self.max_bytes:
+                    break
+                if old == digest:
+                    continue
+                for filename in self._files(old):
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
+                total -= index['caches'].pop(old)['size']
+            index['songs'] = dict((song, known) for song, known in index['songs'].items()
+                                  if known[2] in index['caches'])
+
+    def _files(self, digest):
+        """The files kept for the song with this hash"""
+        return glob.glob(os.path.join(self.path, digest + '.*'))
+
+    def _locked_index(self):
+        """Context manager holding the index, saved when done"""
+        return _LockedIndex(self)
+
+    def _scan(self):
+        """Rebuild the cache entries of a lost or corrupt index"""
+        caches = dict()
+        for name in os.listdir(self.path):
+            digest, extension = os.path.splitext(name)
+            if extension in ('.sync', '.show'):
+                status = os.stat(os.path.join(self.path, name))
+                entry = caches.setdefault(digest, {'size': 0, 'used': 0})
+                entry['size'] += status.st_size
+                entry['used'] = max(entry['used'], status.st_mtime)
+        return {'songs': {}, 'caches': caches}
+
+
+class _LockedIndex(object):
+    """Loads a CacheDirectory index under a lock, and saves it on exit"""
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = None
+        self._index = None
+
+    def __enter__(self):
+        self._lock = open(self._directory._index_filename + '.lock', 'w')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            with open(self._directory._index_filename) as index_file:
+                self._index = json.load(index_file)
+        except (IOError, ValueError):
+            self._index = self._directory._scan()
+        return self._index
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                temporary = self._directory._index_filename + '.tmp'
+                with open(temporary, 'w') as index_file:
+                    json.dump(self._index, index_file)
+                os.rename(temporary, self._directory._index_filename)
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+            self._lock.close()
+
+
+def write(filename, levels, std, mean, parameters, audio=None, encoding='raw'):
+    """Write a sync cache
+
+    The cache is written next to filename and renamed over it when done,
+    so a reader never sees a half written cache.
+
+    :param filename: cache file name
+    :type filename: str
+
+    :param levels: one row of levels per hop
+    :type levels: numpy.array
+
+    :param std: standard deviation of each column of levels
+    :type std: list
+
+    :param mean: mean of each column of levels
+    :type mean: list
+
+    :param parameters: analysis_profile the levels were calculated with
+    :type parameters: dict
+
+    :param audio: audio_signature of the song the levels were calculated for
+    :type audio: dict
+
+    :param encoding: how the levels are stored, see ENCODINGS
+    :type encoding: str
+    """
+    if encoding != 'raw':
+        header = _new_header(levels.shape[1], levels.dtype, parameters, audio, encoding)
+        header['std'] = [float(value) for value in std]
+        header['mean'] = [float(value) for value in mean]
+        _write_compact(filename, header, levels)
+        return
+
+    temporary = filename + '.tmp'
+    writer = create(temporary, levels.shape[1], levels.dtype, parameters, audio)
+    writer.append(levels)
+    writer.finalize(std, mean)
+    os.rename(temporary, filename)
+
+
+def statistics(levels, num_channels):
+    """Standard deviation and mean of each column of levels
+
+    The light channel levels (the first num_channels columns) only count
+    the rows with a level (above 0), the rest of the columns (onset
+    strength, beat flag) count every row.
+
+    :param levels: one row of levels per hop
+    :type levels: numpy.array
+
+    :param num_channels: number of light channels
+    :type num_channels: int
+
+    :return: std and mean of each column
+    :rtype: tuple
+    """
+    std = []
+    mean = []
+    for i in range(0, num_channels):
+        std.append(np.std([item for item in levels[:, i] if item > 0]))
+        mean.append(np.mean([item for item in levels[:, i] if item > 0]))
+    std.extend(np.std(levels[:, num_channels:], axis=0))
+    mean.extend(np.mean(levels[:, num_channels:], axis=0))
+    return std, mean
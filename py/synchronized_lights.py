@@ -30,8 +30,8 @@ FFT calculation can be CPU intensive and in some cases can adversely
 affect playback of songs (especially if attempting to decode the song
 as well, as is the case for an mp3).  For this reason, the FFT 
 cacluations are cached after the first time a new song is played.
-The values are cached in a gzip'd text file in the same location as the
-song itself.  Subsequent requests to play the same song will use the
+The values are cached in a binary file (see sync_cache.py) in the same
+location as the song itself.  Subsequent requests to play the same song will use the
 cached information and not recompute the FFT, thus reducing CPU
 utilization dramatically and allowing for clear music playback of all
 audio file types.
@@ -67,38 +67,31 @@ import json
 import logging
 import os
 import random
+import signal
 import subprocess
 import sys
-import wave
+import time
 
 import alsaaudio as aa
+import analysis
+import beat
 import fft
+import filterbank
 import configuration_manager as cm
-import decoder
 import hardware_controller as hc
+import light_show
 import numpy as np
+import sync_cache
 
+from look_ahead import LookAhead
+from playback import Playback
 from prepostshow import PrePostShow
 
 
 # Configurations - TODO(todd): Move more of this into configuration manager
 _CONFIG = cm.CONFIG
 _MODE = cm.lightshow()['mode']
-_MIN_FREQUENCY = _CONFIG.getfloat('audio_processing', 'min_frequency')
-_MAX_FREQUENCY = _CONFIG.getfloat('audio_processing', 'max_frequency')
 _RANDOMIZE_PLAYLIST = _CONFIG.getboolean('lightshow', 'randomize_playlist')
-try:
-    _CUSTOM_CHANNEL_MAPPING = \
-        [int(channel) for channel in _CONFIG.get('audio_processing',\
-            'custom_channel_mapping').split(',')]
-except:
-    _CUSTOM_CHANNEL_MAPPING = 0
-try:
-    _CUSTOM_CHANNEL_FREQUENCIES = [int(channel) for channel in
-                                   _CONFIG.get('audio_processing',
-                                               'custom_channel_frequencies').split(',')]
-except:
-    _CUSTOM_CHANNEL_FREQUENCIES = 0
 try:
     _PLAYLIST_PATH = \
         cm.lightshow()['playlist_path'].replace('$SYNCHRONIZED_LIGHTS_HOME', cm.HOME_DIR)
@@ -111,132 +104,126 @@ try:
     music_pipe_r,music_pipe_w = os.pipe()	
 except:
     _usefm='false'
-CHUNK_SIZE = 2048  # Use a multiple of 8 (move this to config)
+_AUDIO_IN_ENGINE = _CONFIG.get('audio_processing', 'audio_in_engine')
+_AUDIO_IN_PERIOD_SIZE = _CONFIG.getint('audio_processing', 'audio_in_period_size')
+
+# Seconds of audio analyzed before the end of a partial cache, to warm up
+# the beat tracker before the rest of the song is calculated
+_RESUME_WARMUP = 10.0
+
+# Rows a partial cache needs for its mean / std to be used while playing
+_PARTIAL_STATS_ROWS = 250
+
+# Seconds of decoded audio buffered ahead of the sound card
+_PLAYBACK_BUFFER = 1.5
+
+# Seconds between checks of the application state (play_now) while playing
+_STATE_INTERVAL = 0.25
+
+# Row (hop or audio-in period) of the last beat flagged, for beat_channels
+_last_beat = None
 
 def end_early():
     hc.clean_up()
     
 atexit.register(end_early)
 
-def calculate_channel_frequency(min_frequency, max_frequency, custom_channel_mapping,
-                                custom_channel_frequencies):
-    """
-    Calculate frequency values
-
-    Calculate frequency values for each channel,
-    taking into account custom settings.
-    """
-
-    # How many channels do we need to calculate the frequency for
-    if custom_channel_mapping != 0 and len(custom_channel_mapping) == hc.GPIOLEN:
-        logging.debug("Custom Channel Mapping is being used: %s", str(custom_channel_mapping))
-        channel_length = max(custom_channel_mapping)
-    else:
-        logging.debug("Normal Channel Mapping is being used.")
-        channel_length = hc.GPIOLEN
-
-    logging.debug("Calculating frequencies for %d channels.", channel_length)
-    octaves = (np.log(max_frequency / min_frequency)) / np.log(2)
-    logging.debug("octaves in selected frequency range ... %s", octaves)
-    octaves_per_channel = octaves / channel_length
-    frequency_limits = []
-    frequency_store = []
-
-    frequency_limits.append(min_frequency)
-    if custom_channel_frequencies != 0 and (len(custom_channel_frequencies) >= channel_length + 1):
-        logging.debug("Custom channel frequencies are being used")
-        frequency_limits = custom_channel_frequencies
-    else:
-        logging.debug("Custom channel frequencies are not being used")
-        for i in range(1, hc.GPIOLEN + 1):
-            frequency_limits.append(frequency_limits[-1]
-                                    * 10 ** (3 / (10 * (1 / octaves_per_channel))))
-    for i in range(0, channel_length):
-        frequency_store.append((frequency_limits[i], frequency_limits[i + 1]))
-        logging.debug("channel %d is %6.2f to %6.2f ", i, frequency_limits[i],
-                      frequency_limits[i + 1])
-
-    # we have the frequencies now lets map them if custom mapping is defined
-    if custom_channel_mapping != 0 and len(custom_channel_mapping) == hc.GPIOLEN:
-        frequency_map = []
-        for i in range(0, hc.GPIOLEN):
-            mapped_channel = custom_channel_mapping[i] - 1
-            mapped_frequency_set = frequency_store[mapped_channel]
-            mapped_frequency_set_low = mapped_frequency_set[0]
-            mapped_frequency_set_high = mapped_frequency_set[1]
-            logging.debug("mapped channel: " + str(mapped_channel) + " will hold LOW: "
-                          + str(mapped_frequency_set_low) + " HIGH: "
-                          + str(mapped_frequency_set_high))
-            frequency_map.append(mapped_frequency_set)
-        return frequency_map
-    else:
-        return frequency_store
-
-def update_lights(matrix, mean, std):
+def update_lights(matrix, mean, std, row, hop_seconds):
     """
     Update the state of all the lights
 
     Update the state of all the lights based upon the current
-    frequency response matrix
+    frequency response matrix, beat_channels flash on the beat flag
+    following the levels.  The flash fades with the rows played, as in a
+    rendered light show (see light_show.beat_flash), so it follows the
+    audio rather than the wall clock.
+
+    :param row: the row (hop or audio-in period) of matrix
+    :type row: int
+
+    :param hop_seconds: length of a row
+    :type hop_seconds: float
     """
-    for i in range(0, hc.GPIOLEN):
-        # Calculate output pwm, where off is at some portion of the std below
-        # the mean and full on is at some portion of the std above the mean.
-        brightness = matrix[i] - mean[i] + 0.5 * std[i]
-        brightness = brightness / (1.25 * std[i])
-        if brightness > 1.0:
-            brightness = 1.0
-        if brightness < 0:
-            brightness = 0
-        if not hc.is_pin_pwm(i):
-            # If pin is on / off mode we'll turn on at 1/2 brightness
-            if (brightness > 0.5):
-                hc.turn_on_light(i, True)
-            else:
-                hc.turn_off_light(i, True)
+    global _last_beat
+    brightness = light_show.brightness(matrix[:hc.GPIOLEN], mean[:hc.GPIOLEN],
+                                       std[:hc.GPIOLEN])
+    if analysis.BEAT_CHANNELS:
+        if len(matrix) > analysis.BEAT_COLUMN and matrix[analysis.BEAT_COLUMN]:
+            _last_beat = row
+        if _last_beat is None:
+            brightness[analysis.BEAT_CHANNELS] = 0.0
         else:
-            hc.turn_on_light(i, True, brightness)
+            brightness[analysis.BEAT_CHANNELS] = light_show.flash_fade(
+                (row - _last_beat) * hop_seconds, analysis.BEAT_FLASH_LENGTH)
+    hc.set_brightness(brightness)
 
 def audio_in():
     """Control the lightshow from audio coming in from a USB audio card"""
     sample_rate = cm.lightshow()['audio_in_sample_rate']
     input_channels = cm.lightshow()['audio_in_channels']
 
+    # The filterbank keeps its own state between reads and can work on much
+    # smaller periods than the FFT window
+    if _AUDIO_IN_ENGINE == 'filterbank':
+        if filterbank.lfilter is None:
+            logging.error("audio_in_engine = filterbank needs scipy (sudo apt-get install "
+                          "python-scipy), use audio_in_engine = fft without it")
+            sys.exit()
+        period_size = _AUDIO_IN_PERIOD_SIZE
+    else:
+        period_size = analysis.HOP_SIZE
+
     # Open the input stream from default input device
     stream = aa.PCM(aa.PCM_CAPTURE, aa.PCM_NORMAL, cm.lightshow()['audio_in_card'])
     stream.setchannels(input_channels)
     stream.setformat(aa.PCM_FORMAT_S16_LE) # Expose in config if needed
     stream.setrate(sample_rate)
-    stream.setperiodsize(CHUNK_SIZE)
+    stream.setperiodsize(period_size)
          
     logging.debug("Running in audio-in mode - will run until Ctrl+C is pressed")
     print "Running in audio-in mode, use Ctrl+C to stop"
     try:
         hc.initialize()
-        frequency_limits = calculate_channel_frequency(_MIN_FREQUENCY,
-                                                       _MAX_FREQUENCY,
-                                                       _CUSTOM_CHANNEL_MAPPING,
-                                                       _CUSTOM_CHANNEL_FREQUENCIES)
+        if _AUDIO_IN_ENGINE == 'filterbank':
+            logging.debug("Using the filterbank analysis engine")
+            analyzer = filterbank.FilterBank(sample_rate,
+                                             analysis.channel_frequency_limits(),
+                                             hc.GPIOLEN,
+                                             input_channels,
+                                             analysis.CHANNEL_MODE)
+            ring = None
+        else:
+            analyzer = analysis.analysis_plan(sample_rate, input_channels)
+            ring = fft.SampleRing(analysis.CHUNK_SIZE, analysis.HOP_SIZE, input_channels)
+        tracker = beat.BeatTracker(period_size, sample_rate)
 
         # Start with these as our initial guesses - will calculate a rolling mean / std 
         # as we get input data.
         mean = [12.0 for _ in range(hc.GPIOLEN)]
         std = [0.5 for _ in range(hc.GPIOLEN)]
-        recent_samples = np.empty((250, hc.GPIOLEN))
+
+        # Compute the running mean / std over about the same length of audio
+        # whatever the period size (250 periods of 2048 frames)
+        stats_samples = max(250, 250 * 2048 // period_size)
+        recent_samples = np.empty((stats_samples, hc.GPIOLEN))
         num_samples = 0
+
+        # Periods read so far, the clock the beat flashes fade on
+        period = -1
+        period_seconds = period_size / float(sample_rate)
     
         # Listen on the audio input device until CTRL-C is pressed
         while True:            
             l, data = stream.read()
             
             if l:
+                period += 1
                 try:
-                    matrix = fft.calculate_levels(data,
-                                                  CHUNK_SIZE,
-                                                  sample_rate,
-                                                  frequency_limits,
-                                                  hc.GPIOLEN,
-                                                  input_channels)
+                    if ring is not None:
+                        ring.push(data)
+                        data = ring.samples()
+                    matrix = analyzer.calculate_levels(data)
+                    matrix = np.append(matrix, tracker.process(analyzer.power)[0])
                     if not np.isfinite(np.sum(matrix)):
                         # Bad data --- skip it
                         continue
@@ -249,13 +236,13 @@ def audio_in():
                     logging.debug("skipping update: " + str(e))
                     continue
 
-                update_lights(matrix, mean, std)
+                update_lights(matrix, mean, std, period, period_seconds)
 
                 # Keep track of the last N samples to compute a running std / mean
                 #
                 # TODO(todd): Look into using this algorithm to compute this on a per sample basis:
                 # http://www.johndcook.com/blog/standard_deviation/                
-                if num_samples >= 250:
+                if num_samples >= stats_samples:
                     no_connection_ct = 0
                     for i in range(0, hc.GPIOLEN):
                         mean[i] = np.mean([item for item in recent_samples[:, i] if item > 0])
@@ -390,10 +377,7 @@ def play_song():
     matrix = [0 for _ in range(hc.GPIOLEN)]
 
     # Set up audio
-    if song_filename.endswith('.wav'):
-        musicfile = wave.open(song_filename, 'r')
-    else:
-        musicfile = decoder.open(song_filename)
+    musicfile = analysis.open_song(song_filename)
 
     sample_rate = musicfile.getframerate()
     num_channels = musicfile.getnchannels()
@@ -417,18 +401,22 @@ def play_song():
         output.setchannels(num_channels)
         output.setrate(sample_rate)
         output.setformat(aa.PCM_FORMAT_S16_LE)
-        output.setperiodsize(CHUNK_SIZE)
+        output.setperiodsize(analysis.HOP_SIZE)
     
     logging.info("Playing: " + song_filename + " (" + str(musicfile.getnframes() / sample_rate)
                  + " sec)")
     # Output a bit about what we're about to play to the logs
     song_filename = os.path.abspath(song_filename)
     
-    # create empty array for the cache_matrix
-    cache_matrix = np.empty(shape=[0, hc.GPIOLEN])
+    # create the buffer the levels are cached in, sized for the whole song
+    song_rows = sync_cache.expected_rows(musicfile.getnframes(), analysis.HOP_SIZE)
+    cache_matrix = None
     cache_found = False
-    cache_filename = \
-        os.path.dirname(song_filename) + "/." + os.path.basename(song_filename) + ".sync"
+    cache = None
+    cache_filename, audio = sync_cache.locate(song_filename, analysis.CACHE_DIRECTORY)
+    show = None
+    show_filename = light_show.show_filename(cache_filename)
+    hop_seconds = analysis.HOP_SIZE / float(sample_rate)
     
     # The values 12 and 1.5 are good estimates for first time playing back 
     # (i.e. before we have the actual mean and standard deviations 
@@ -436,84 +424,164 @@ def play_song():
     mean = [12.0 for _ in range(hc.GPIOLEN)]
     std = [1.5 for _ in range(hc.GPIOLEN)]
     
-    if args.readcache:
+    if args.readcache and analysis.RENDER_SHOWS:
+        # Play the pre-rendered light show if there is one
+        try:
+            show = light_show.load(show_filename, analysis.RENDER_PARAMETERS, audio)
+        except sync_cache.StaleCacheError as error:
+            logging.info("Light show '" + show_filename + "' is stale, it will be rendered "
+                         "again (" + str(error) + ")")
+        except IOError as error:
+            logging.info("No light show rendered for this song yet (" + str(error) + ")")
+
+    if args.readcache and show is None:
         # Read in cached fft
         try:
-            # load cache from file using numpy loadtxt
-            cache_matrix = np.loadtxt(cache_filename)
-            cache_found = True
-
-            # get std from matrix / located at index 0
-            std = np.array(cache_matrix[0])
-
-            # get mean from matrix / located at index 1
-            mean = np.array(cache_matrix[1])
+            # open the cache, the levels are read as they are played
+            cache = sync_cache.SyncCache(cache_filename)
 
-            # delete mean and std from the array
-            cache_matrix = np.delete(cache_matrix, (0), axis = 0)
-            cache_matrix = np.delete(cache_matrix, (0), axis = 0)
+            # check the cache was generated with the same settings and audio
+            cache.check(analysis.CACHE_PARAMETERS, audio)
 
+            cache_matrix = cache.levels
+            cache_found = True
+            if cache.complete:
+                std = cache.std
+                mean = cache.mean
+            else:
+                logging.info("Using the incomplete cached sync data for the first "
+                             + str(len(cache_matrix)) + " rows")
+                if len(cache_matrix) >= _PARTIAL_STATS_ROWS:
+                    std, mean = sync_cache.statistics(cache_matrix, hc.GPIOLEN)
             logging.debug("std: " + str(std) + ", mean: " + str(mean))
-        except IOError:
+        except sync_cache.StaleCacheError as error:
+            cache = None
+            logging.info("Cached sync data '" + cache_filename + "' is stale, rebuilding it ("
+                         + str(error) + ")")
+        except IOError as error:
+            cache = None
             logging.warn("Cached sync data song_filename not found: '" 
                          + cache_filename
-                         + ".  One will be generated.")
+                         + ".  One will be generated. (" + str(error) + ")")
+
+        if analysis.RENDER_SHOWS and cache_found and cache.complete:
+            show = analysis.render_show(show_filename, cache_matrix, mean, std, hop_seconds,
+                                        audio)
 
     # Process audio song_filename
     row = 0
-    data = musicfile.readframes(CHUNK_SIZE)
-    frequency_limits = calculate_channel_frequency(_MIN_FREQUENCY,
-                                                   _MAX_FREQUENCY,
-                                                   _CUSTOM_CHANNEL_MAPPING,
-                                                   _CUSTOM_CHANNEL_FREQUENCIES)
-
-    while data != '' and not play_now:
-        if _usefm=='true':
-            os.write(music_pipe_w, data)
+    song = analysis.SongAnalysis(sample_rate, num_channels)
+
+    look_ahead = None
+    if show is None and not (cache_found and cache.complete):
+        # Analyze the (rest of the) song ahead of the audio, writing the
+        # cache as it goes, so the lights use the levels and the mean / std
+        # of the song long before it has played
+        levels = sync_cache.LevelBuffer(analysis.BEAT_COLUMN + 1, analysis.ANALYSIS_DTYPE,
+                                        song_rows)
+        warmup_row = 0
+        if cache_found:
+            # carry on after the rows already cached, starting the analysis
+            # a little earlier so the beat tracker has caught up by then
+            levels.append(cache_matrix)
+            warmup_row = len(cache_matrix) - int(_RESUME_WARMUP / hop_seconds)
+            cache_writer = sync_cache.resume(cache)
+            cache_matrix = cache = None
         else:
-            output.write(data)
+            cache_writer = sync_cache.create(cache_filename, analysis.BEAT_COLUMN + 1,
+                                             analysis.ANALYSIS_DTYPE, analysis.CACHE_PARAMETERS,
+                                             audio, analysis.CACHE_ENCODING)
+        look_ahead = LookAhead(analysis.open_song(song_filename),
+                               analysis.SongAnalysis(sample_rate, num_channels),
+                               levels,
+                               cache_writer,
+                               hc.GPIOLEN,
+                               analysis.HOP_SIZE,
+                               warmup_row=warmup_row,
+                               min_rows=_PARTIAL_STATS_ROWS)
+        look_ahead.start()
+
+    # Decode and play the song in their own threads, the lights follow the
+    # hops as they are played
+    if _usefm=='true':
+        write_audio = lambda hop: os.write(music_pipe_w, hop)
+    else:
+        write_audio = output.write
+    playback = Playback(musicfile, write_audio, analysis.HOP_SIZE, num_channels,
+                        max(int(_PLAYBACK_BUFFER / hop_seconds), 4))
+    playback.start()
+    state_loaded = time.time()
+    skipped = 0
+    writes = hc.write_counts()
 
-        # Control lights with cached timing values if they exist
-        matrix = None
-        if cache_found and args.readcache:
-            if row < len(cache_matrix):
-                matrix = cache_matrix[row]
+    try:
+        while not play_now and playback.wait(row):
+            # Light the latest hop played.  Every hop played since the last
+            # update goes through the analysis window, so the FFT can take
+            # over if neither the cache nor the look-ahead has the levels
+            played = playback.played
+            if show is None:
+                for hop in range(row, played):
+                    song.push(playback.hop(hop))
+            playback.release(played)
+            skipped += played - row - 1
+            row = played - 1
+
+            if show is not None:
+                # Pre-rendered light show, just write this hop's frame
+                if row < len(show):
+                    hc.write_frame(show.levels[row])
             else:
-                logging.warning("Ran out of cached FFT values, will update the cache.")
-                cache_found = False
-
-        if matrix == None:
-            # No cache - Compute FFT in this chunk, and cache results
-            matrix = fft.calculate_levels(data, CHUNK_SIZE, sample_rate, frequency_limits, hc.GPIOLEN)
-
-            # Add the matrix to the end of the cache 
-            cache_matrix = np.vstack([cache_matrix, matrix])
-            
-        update_lights(matrix, mean, std)
-
-        # Read next chunk of data from music song_filename
-        data = musicfile.readframes(CHUNK_SIZE)
-        row = row + 1
-
-        # Load new application state in case we've been interrupted
-        cm.load_state()
-        play_now = int(cm.get_state('play_now', 0))
-
-    if not cache_found:
-        # Compute the standard deviation and mean values for the cache
-        for i in range(0, hc.GPIOLEN):
-            std[i] = np.std([item for item in cache_matrix[:, i] if item > 0])
-            mean[i] = np.mean([item for item in cache_matrix[:, i] if item > 0])
-
-        # Add mean and std to the top of the cache
-        cache_matrix = np.vstack([mean, cache_matrix])
-        cache_matrix = np.vstack([std, cache_matrix])
-
-        # Save the cache using numpy savetxt
-        np.savetxt(cache_filename, cache_matrix)
-        
+                # Control lights with cached timing values if they exist
+                matrix = None
+                if look_ahead is not None:
+                    matrix = look_ahead.row(row)
+                    if look_ahead.statistics is not None:
+                        std, mean = look_ahead.statistics
+                elif row < len(cache_matrix):
+                    matrix = cache_matrix[row]
+
+                if matrix is None:
+                    # Compute FFT over the latest window
+                    matrix = song.latest()
+
+                update_lights(matrix, mean, std, row, hop_seconds)
+            row = played
+
+            # Load new application state in case we've been interrupted
+            now = time.time()
+            if now - state_loaded >= _STATE_INTERVAL:
+                cm.load_state()
+                play_now = int(cm.get_state('play_now', 0))
+                state_loaded = now
+
+        if look_ahead is not None and playback.finished:
+            # Let the analysis finish, so the cache is complete
+            look_ahead.join()
+    finally:
+        playback.stop()
+        if skipped:
+            logging.debug("Lights skipped " + str(skipped) + " hops to keep up with the audio")
+        written = hc.write_counts()
+        logging.debug("Pin writes: " + str(written['written'] - writes['written'])
+                      + " written, " + str(written['skipped'] - writes['skipped'])
+                      + " skipped as unchanged")
+        if look_ahead is not None and look_ahead.is_alive():
+            # Keep the rows calculated so far, the next play resumes the cache
+            look_ahead.stop()
+        if look_ahead is not None and not look_ahead.complete:
+            logging.info("Incomplete sync data written to '." + cache_filename
+                         + "' [" + str(look_ahead.rows) + " rows]")
+        if (look_ahead is not None or show is not None) and analysis.CACHE_DIRECTORY is not None:
+            analysis.CACHE_DIRECTORY.store(cache_filename)
+
+    if look_ahead is not None and look_ahead.complete:
         logging.info("Cached sync data written to '." + cache_filename
-                        + "' [" + str(len(cache_matrix)) + " rows]")
+                     + "' [" + str(look_ahead.rows) + " rows]")
+        if analysis.RENDER_SHOWS:
+            std, mean = look_ahead.statistics
+            analysis.render_show(show_filename, look_ahead.levels.levels, mean, std, hop_seconds,
+                                 audio)
 
     # Cleanup the pifm process
     if _usefm=='true':
@@ -533,6 +601,10 @@ if __name__ == "__main__":
                         ' - %(message)s',
                         level=logging.DEBUG)
 
+    # Exit cleanly when stopped (stop_music_and_lights), so the lights are
+    # turned off and the sync data calculated so far is kept
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     if cm.lightshow()['mode'] == 'audio-in':
         audio_in()
     else:
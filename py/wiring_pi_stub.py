@@ -1,6 +1,8 @@
 import os
 
 class WiringPiStub:
+    _is_stubbed = True
+
     @classmethod
     def import_wiringpi2(cls, logger):
         is_pi = "raspberrypi" in os.uname()
@@ -65,3 +67,19 @@ class WiringPiStub:
     def pcf8574Setup(self, *args):
         pass
 
+    # I2C / SPI
+    def wiringPiI2CSetup(self, *args):
+        return -1
+
+    def wiringPiI2CWrite(self, *args):
+        pass
+
+    def wiringPiI2CWriteReg8(self, *args):
+        pass
+
+    def wiringPiI2CWriteReg16(self, *args):
+        pass
+
+    def wiringPiSPIDataRW(self, *args):
+        pass
+
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Benchmark the audio analysis used to generate sync files.
+
+Compares analyzing a song one chunk at a time (as is done during
+playback) against the batched FFT used by sync_file_generator.py, and the
+float64 analysis against the float32 analysis, using synthetic audio so
+no decoder or sound card is needed.
+
+The time of each stage of the batched analysis (windowing, FFT and power
+spectrum, band sums, log10) is shown too.  Every stage already works on
+the whole batch, and the FFT takes most of the time whichever way the
+chunks are analyzed, so batching only saves the per chunk python
+overhead: it measured 1.8x to 1.9x faster for 2048 frame chunks of
+stereo audio in 256 chunk batches, with 8 and 64 bins.
+
+The float32 levels are checked against the float64 levels, and the
+script exits with an error if they differ by more than
+FLOAT32_TOLERANCE.
+
+Sample usage:
+
+python analysis_benchmark.py --seconds=300
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+sys.path.insert(0, HOME_DIR + "/py")
+
+import fft
+
+# Largest difference allowed between float32 and float64 levels (log10 power)
+FLOAT32_TOLERANCE = 1e-3
+
+
+def synthetic_pcm(seconds, sample_rate, num_channels):
+    """Interleaved int16 audio of a few tones plus noise
+
+    :param seconds: length of the audio
+    :type seconds: float
+
+    :param sample_rate: audio sample rate
+    :type sample_rate: int
+
+    :param num_channels: number of interleaved channels
+    :type num_channels: int
+
+    :return: raw audio data as returned by readframes
+    :rtype: str
+    """
+    times = np.arange(int(seconds * sample_rate)) / float(sample_rate)
+    signal = np.zeros(len(times))
+    for frequency in (55.0, 440.0, 3520.0):
+        signal += np.sin(2 * np.pi * frequency * times)
+    signal += np.random.uniform(-0.5, 0.5, len(times))
+    signal *= 32767 / np.abs(signal).max()
+    return np.repeat(signal.astype(np.int16), num_channels).tostring()
+
+
+def octave_limits(num_bins, min_frequency=20.0, max_frequency=15000.0):
+    """Evenly divide the frequency range into num_bins log spaced channels"""
+    edges = np.logspace(np.log10(min_frequency), np.log10(max_frequency), num_bins + 1)
+    return zip(edges[:-1], edges[1:])
+
+
+def per_chunk(data, plan):
+    """Analyze one chunk at a time, as playback does"""
+    chunk_bytes = plan.chunk_size * plan.input_channels * 2
+    rows = [plan.calculate_levels(data[start:start + chunk_bytes])
+            for start in range(0, len(data), chunk_bytes)]
+    return np.vstack(rows)
+
+
+def batched(data, plan, batch_chunks):
+    """Analyze batch_chunks chunks at a time, as sync_file_generator does"""
+    block_bytes = plan.chunk_size * plan.input_channels * 2 * batch_chunks
+    blocks = [plan.calculate_levels_batch(fft.frames_from_pcm(data[start:start + block_bytes],
+                                                              plan.chunk_size,
+                                                              plan.input_channels))
+              for start in range(0, len(data), block_bytes)]
+    return np.vstack(blocks)
+
+
+def batch_stages(data, plan, batch_chunks, repeat):
+    """Best time of each stage of the batched analysis of one block
+
+    :return: (stage, seconds per chunk) pairs
+    :rtype: list
+    """
+    frames = fft.frames_from_pcm(data, plan.chunk_size, plan.input_channels)[:batch_chunks]
+    windowed = np.empty((len(frames), plan.num_sources, plan.chunk_size), dtype=plan.dtype)
+    power = np.empty((len(frames), plan.num_sources, plan.spectrum_size), dtype=plan.dtype)
+    sums = plan.weights.dot(power.reshape(-1, plan.spectrum_size).T)
+    stages = [('window', lambda: plan._window_sources(frames, windowed)),
+              ('fft + power', lambda: plan._power_spectrum(windowed, power)),
+              ('band sums', lambda: plan.weights.dot(power.reshape(-1, plan.spectrum_size).T)),
+              ('log10', lambda: fft._log_levels(sums))]
+    return [(name, best_time(stage, repeat)[0] / len(frames)) for name, stage in stages]
+
+
+def best_time(function, repeat):
+    """Best wall clock time (and result) of calling function repeat times"""
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=60.0,
+                        help='length of the synthetic song in seconds')
+    parser.add_argument('--sample-rate', type=int, default=44100)
+    parser.add_argument('--channels', type=int, default=2,
+                        help='number of interleaved audio channels')
+    parser.add_argument('--chunk-size', type=int, default=2048)
+    parser.add_argument('--bins', type=int, default=8,
+                        help='number of light channels')
+    parser.add_argument('--batch-chunks', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    data = synthetic_pcm(args.seconds, args.sample_rate, args.channels)
+    limits = octave_limits(args.bins)
+    plan = fft.AnalysisPlan(args.chunk_size, args.sample_rate, limits, args.bins, args.channels)
+    single = fft.AnalysisPlan(args.chunk_size, args.sample_rate, limits, args.bins,
+                              args.channels, dtype='float32')
+
+    chunk_time, chunk_levels = best_time(lambda: per_chunk(data, plan), args.repeat)
+    batch_time, batch_levels = best_time(lambda: batched(data, plan, args.batch_chunks),
+                                         args.repeat)
+    single_chunk_time, single_chunk_levels = best_time(lambda: per_chunk(data, single),
+                                                       args.repeat)
+    single_batch_time, single_batch_levels = \
+        best_time(lambda: batched(data, single, args.batch_chunks), args.repeat)
+
+    print "%d chunks of %d frames, %d channels, %d bins" % \
+        (len(chunk_levels), args.chunk_size, args.channels, args.bins)
+    print "per chunk: %8.3f s (%7.1f us/chunk)" % \
+        (chunk_time, 1e6 * chunk_time / len(chunk_levels))
+    print "batched:   %8.3f s (%7.1f us/chunk)" % \
+        (batch_time, 1e6 * batch_time / len(batch_levels))
+    print "per chunk / batched: %.1fx" % (chunk_time / batch_time)
+    print "max difference: %g" % np.abs(chunk_levels - batch_levels).max()
+    print
+    print "batched stages: " + ", ".join("%s %.1f us" % (name, 1e6 * seconds) for name, seconds
+                                         in batch_stages(data, plan, args.batch_chunks,
+                                                         args.repeat))
+    print
+    print "float32 per chunk: %8.3f s (%7.1f us/chunk)" % \
+        (single_chunk_time, 1e6 * single_chunk_time / len(single_chunk_levels))
+    print "float32 batched:   %8.3f s (%7.1f us/chunk)" % \
+        (single_batch_time, 1e6 * single_batch_time / len(single_batch_levels))
+    print "float32 levels:    %8.1f KB (float64 %.1f KB)" % \
+        (single_batch_levels.nbytes / 1024.0, batch_levels.nbytes / 1024.0)
+
+    error = max(np.abs(single_chunk_levels - chunk_levels).max(),
+                np.abs(single_batch_levels - batch_levels).max())
+    print "float32 max difference: %g (tolerance %g)" % (error, FLOAT32_TOLERANCE)
+    if error > FLOAT32_TOLERANCE:
+        sys.exit("float32 levels differ from float64 levels by more than the tolerance")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Check the size and accuracy of the compact sync cache encodings.
+
+Analyzes a synthetic song (or a wav file) the way sync_file_generator.py
+does, writes its sync cache in each of sync_cache.ENCODINGS, reads it
+back and compares the levels, and the brightness update_lights would
+give them, with the float64 levels.
+
+The script exits with an error if a decoded level is further from the
+float64 level than its encoding allows: half a step (the column's scale)
+for uint8, the float16 rounding error of the difference from the
+column's mean for float16, and nothing for raw.
+
+Sample usage:
+
+python cache_encoding_check.py --channels=64 --seconds=240
+python cache_encoding_check.py --wav=song.wav --songs=60
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import wave
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+sys.path.insert(0, HOME_DIR + "/py")
+
+import beat
+import fft
+import sync_cache
+from analysis_benchmark import synthetic_pcm, octave_limits
+
+# Relative rounding error of float16 (10 bit mantissa)
+FLOAT16_EPSILON = 2.0 ** -11
+
+# Absolute rounding error of float16 close to 0 (half its smallest subnormal)
+FLOAT16_SUBNORMAL = 2.0 ** -25
+
+
+def analyze(data, sample_rate, num_channels, num_bins, chunk_size):
+    """float64 levels, onset strength and beat flag of every hop"""
+    plan = fft.AnalysisPlan(chunk_size, sample_rate, octave_limits(num_bins), num_bins,
+                            num_channels)
+    ring = fft.SampleRing(chunk_size, chunk_size, num_channels)
+    tracker = beat.BeatTracker(chunk_size, sample_rate)
+    levels = plan.calculate_levels_batch(ring.frames(data))
+    return np.hstack([levels, tracker.process(plan.power)])
+
+
+def brightness(levels, mean, std):
+    """The brightness update_lights gives each channel level"""
+    return np.clip((levels - mean + 0.5 * std) / (1.25 * std), 0.0, 1.0)
+
+
+def allowed_error(cache, levels):
+    """Largest difference from levels each decoded level may have"""
+    if cache.encoding == 'uint8':
+        return np.array(cache.header['scale']) * 0.5 * (1 + 1e-9)
+    if cache.encoding == 'float16':
+        offset = np.array(cache.header['offset'])
+        return np.abs(levels - offset) * FLOAT16_EPSILON + FLOAT16_SUBNORMAL
+    return np.zeros(levels.shape[1])
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=240.0,
+                        help='length of the synthetic song in seconds')
+    parser.add_argument('--wav', help='analyze this wav file instead of a synthetic song')
+    parser.add_argument('--channels', type=int, default=64, help='number of light channels')
+    parser.add_argument('--chunk-size', type=int, default=2048)
+    parser.add_argument('--songs', type=int, default=100,
+                        help='number of songs in a season, to estimate the size of its caches')
+    args = parser.parse_args()
+
+    if args.wav:
+        song = wave.open(args.wav, 'r')
+        sample_rate, num_channels = song.getframerate(), song.getnchannels()
+        data = song.readframes(song.getnframes())
+    else:
+        sample_rate, num_channels = 44100, 2
+        data = synthetic_pcm(args.seconds, sample_rate, num_channels)
+
+    levels = analyze(data, sample_rate, num_channels, args.channels, args.chunk_size)
+    std, mean = sync_cache.statistics(levels, args.channels)
+    channels = slice(0, args.channels)
+    mean, std = np.array(mean[channels]), np.array(std[channels])
+    expected = brightness(levels[:, channels], mean, std)
+
+    print "%d rows of %d columns" % levels.shape
+    failed = False
+    directory = tempfile.mkdtemp()
+    try:
+        for encoding in sync_cache.ENCODINGS:
+            filename = os.path.join(directory, encoding + '.sync')
+            sync_cache.write(filename, levels, std, mean, {}, encoding=encoding)
+            cache = sync_cache.SyncCache(filename)
+            size = os.path.getsize(filename)
+
+            error = np.abs(cache.levels - levels)
+            over = error > allowed_error(cache, levels)
+            light_error = np.abs(brightness(cache.levels[:, channels], mean, std)
+                                 - expected).max()
+
+            print "%-8s %9.1f KB  (%6.1f MB for %d songs)  level error %.4f  " \
+                "brightness error %.4f (%.2f/255)%s" % \
+                (encoding, size / 1024.0, size * args.songs / 1024.0 ** 2, args.songs,
+                 error.max(), light_error, light_error * 255,
+                 '  OVER BOUND' if over.any() else '')
+            failed = failed or over.any() or len(cache) != len(levels)
+    finally:
+        shutil.rmtree(directory)
+
+    if failed:
+        sys.exit("decoded levels differ from the float64 levels by more than the encoding allows")
+
+if __name__ == "__main__":
+    main()
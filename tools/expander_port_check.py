@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Count the bus transfers of writing lights on port expanders.
+
+Sets up hardware_controller with every channel on simulated port
+expanders, writes random frames of lights a pin at a time (wiringPi's
+digitalWrite) and with expander_port_writes, and prints the i2c / spi
+transfers per frame of each.
+
+The expanders are simulated at the register level: digitalWrite on an
+expander pin sends the port's output latch the way wiringPi does, and
+the port writes go through the i2c / spi calls to the same registers.
+After every frame the pin levels read back from the registers are
+checked against the frame, and the script exits with an error if any
+differ, or if a port write frame took more than one transfer per
+expander.
+
+Sample usage:
+
+python expander_port_check.py --device=mcp23017 --chips=4
+python expander_port_check.py --device=pcf8574 --chips=8 --changes=0.1
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+sys.path.insert(0, HOME_DIR + "/py")
+
+from stub_hardware import load_hardware
+from wiring_pi_stub import WiringPiStub
+
+# First wiringPi pin number of the simulated expanders
+PIN_BASE = 64
+
+# mcp23x17 registers (IOCON.BANK = 0)
+OLATA = 0x14
+OLATB = 0x15
+
+
+class SimulatedExpander(object):
+    """Registers of a simulated expander"""
+
+    def __init__(self, device, pin_base):
+        self.device = device
+        self.pin_base = pin_base
+        self.num_pins = 8 if device == 'pcf8574' else 16
+        self.registers = bytearray(0x16)
+        # wiringPi's copy of the output latch, it only reads it at setup
+        self.wiringpi_latch = 0
+
+    def has_pin(self, pin):
+        """Is the wiringPi pin number one of the expander's pins"""
+        return self.pin_base <= pin < self.pin_base + self.num_pins
+
+    @property
+    def latch(self):
+        """The output latch in the registers"""
+        if self.device == 'pcf8574':
+            return self.registers[0]
+        return self.registers[OLATA] | self.registers[OLATB] << 8
+
+
+class SimulatedExpanders(WiringPiStub):
+    """wiringpi stand in with register level expanders, counting bus transfers"""
+
+    def __init__(self):
+        WiringPiStub.__init__(self, logging)
+        self.transfers = 0
+        self.expanders = list()
+        self._i2c = dict()
+        self._spi = dict()
+        self._gpio = dict()
+
+    # Devices
+    def mcp23017Setup(self, pin_base, i2c_address):
+        self._i2c[i2c_address] = self._add('mcp23017', pin_base)
+
+    def mcp23s17Setup(self, pin_base, spi_port, dev_id):
+        self._spi[(spi_port, dev_id)] = self._add('mcp23s17', pin_base)
+
+    def pcf8574Setup(self, pin_base, i2c_address):
+        self._i2c[i2c_address] = self._add('pcf8574', pin_base)
+
+    def _add(self, device, pin_base):
+        expander = SimulatedExpander(device, pin_base)
+        self.expanders.append(expander)
+        return expander
+
+    # Pin writes, as wiringPi's expander drivers do them
+    def digitalWrite(self, pin, value):
+        expander = self._expander(pin)
+        if expander is None:
+            self._gpio[pin] = value
+            return
+        bit = 1 << (pin - expander.pin_base)
+        if value:
+            expander.wiringpi_latch |= bit
+        else:
+            expander.wiringpi_latch &= ~bit
+        self.transfers += 1
+        if expander.device == 'pcf8574':
+            expander.registers[0] = expander.wiringpi_latch
+        elif bit < 0x100:
+            expander.registers[OLATA] = expander.wiringpi_latch & 0xff
+        else:
+            expander.registers[OLATB] = expander.wiringpi_latch >> 8
+
+    # I2C / SPI
+    def wiringPiI2CSetup(self, i2c_address):
+        return i2c_address
+
+    def wiringPiI2CWrite(self, fd, value):
+        self.transfers += 1
+        self._i2c[fd].registers[0] = value & 0xff
+
+    def wiringPiI2CWriteReg8(self, fd, register, value):
+        self.transfers += 1
+        self._i2c[fd].registers[register] = value & 0xff
+
+    def wiringPiI2CWriteReg16(self, fd, register, value):
+        self.transfers += 1
+        self._i2c[fd].registers[register] = value & 0xff
+        self._i2c[fd].registers[register + 1] = (value >> 8) & 0xff
+
+    def wiringPiSPIDataRW(self, spi_port, data):
+        self.transfers += 1
+        data = bytearray(data)
+        expander = self._spi[(spi_port, (data[0] >> 1) & 7)]
+        for offset, value in enumerate(data[2:]):
+            expander.registers[data[1] + offset] = value
+        return len(data), str(data)
+
+    def level(self, pin):
+        """The level of an output pin"""
+        expander = self._expander(pin)
+        if expander is None:
+            return self._gpio.get(pin)
+        return (expander.latch >> (pin - expander.pin_base)) & 1
+
+    def _expander(self, pin):
+        for expander in self.expanders:
+            if expander.has_pin(pin):
+                return expander
+        return None
+
+
+def devices_config(device, chips):
+    """devices configuration for chips expanders, and their pins"""
+    pins_per_chip = 8 if device == 'pcf8574' else 16
+    slaves = list()
+    for chip in range(chips):
+        pin_base = PIN_BASE + chip * pins_per_chip
+        if device == 'mcp23s17':
+            slaves.append({'pinBase': str(pin_base), 'spiPort': '0', 'devId': str(chip)})
+        else:
+            slaves.append({'pinBase': str(pin_base), 'i2cAddress': '%x' % (0x20 + chip)})
+    return {device: slaves}, range(PIN_BASE, PIN_BASE + chips * pins_per_chip)
+
+
+def run(hc, frames):
+    """Write the frames, checking the pin levels after each one
+
+    :return: transfers per frame, and the number of frames with wrong levels
+    :rtype: tuple
+    """
+    wiringpi = hc.wiringpi
+    transfers = wiringpi.transfers
+    wrong = 0
+    for frame in frames:
+        hc.write_frame(frame)
+        levels = [wiringpi.level(pin) for pin in hc._GPIO_PINS]
+        wrong += levels != frame.tolist()
+    return (wiringpi.transfers - transfers) / float(len(frames)), wrong
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', choices=['mcp23017', 'mcp23s17', 'pcf8574'],
+                        default='mcp23017')
+    parser.add_argument('--chips', type=int, default=4, help='number of expanders')
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--changes', type=float, default=0.5,
+                        help='fraction of the channels changing each frame')
+    args = parser.parse_args()
+
+    devices, pins = devices_config(args.device, args.chips)
+    random = np.random.RandomState(0)
+    flips = random.uniform(size=(args.frames, len(pins))) < args.changes
+    states = np.logical_xor.accumulate(flips, axis=0)
+
+    print "%d channels on %d %s" % (len(pins), args.chips, args.device)
+    failed = False
+    for port_writes in (False, True):
+        hc = load_hardware(SimulatedExpanders(), pins, 'onoff', devices=json.dumps(devices),
+                           expander_port_writes=port_writes)
+        hc.initialize(exportpins=False)
+        frames = hc.frame_values(states * 1.0)
+        per_frame, wrong = run(hc, frames)
+        all_change = hc.frame_values(np.ones(len(pins)) * (frames[-1] == hc._GPIOINACTIVE))
+        every_pin, _ = run(hc, [all_change])
+        print "%-16s %6.1f transfers per frame, %3d every channel changing%s" % \
+            ('port writes' if port_writes else 'pin writes', per_frame, every_pin,
+             '  WRONG LEVELS IN %d FRAMES' % wrong if wrong else '')
+        failed = failed or wrong or (port_writes and every_pin > args.chips)
+
+    if failed:
+        sys.exit("expander pin levels differ from the frames, or port writes took too many "
+                 "transfers")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Benchmark the per chunk hot path of the lightshow.
+
+Times each stage run for every chunk of audio, or for every song:
+
+fft                         - fft.calculate_levels, a new analysis per call
+plan                        - fft.AnalysisPlan.calculate_levels, per chunk
+batch                       - fft.AnalysisPlan.calculate_levels_batch, per chunk
+calculate_channel_frequency - analysis, per call
+update_lights               - synchronized_lights, per chunk (onoff and pwm pins)
+write_frame                 - hardware_controller, per chunk of a pre-rendered light show
+                              (every pin changing, and no pin changing)
+
+over a sweep of chunk sizes, light channel counts and mono / stereo audio,
+with tones, noise and the bundled music/sample song (if it can be
+decoded) as input.
+
+The light writes go to the WiringPiStub so no lights are touched (and
+any number of channels can be used), which times the python side of
+update_lights only.  The synchronized_lights stages need its
+dependencies (alsaaudio), they are skipped where it can't be imported.
+
+Results are written as JSON, one record per stage and configuration
+with the best time per call in seconds, along with the machine, python,
+numpy and git commit, so runs can be compared between commits and
+Raspberry Pi models.
+
+Sample usage:
+
+python hot_path_benchmark.py --output=results.json
+python hot_path_benchmark.py --chunk-sizes=2048 --channels=8,64 --signals=noise
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+sys.path.insert(0, HOME_DIR + "/py")
+
+import fft
+from wiring_pi_stub import WiringPiStub
+from stub_hardware import load_hardware
+from analysis_benchmark import octave_limits, best_time
+
+SAMPLE_SONG = HOME_DIR + "/music/sample/ovenrake_deck-the-halls.mp3"
+SAMPLE_RATE = 44100
+
+
+def tones_pcm(frames, num_channels):
+    """Interleaved int16 audio of a few steady tones"""
+    times = np.arange(frames) / float(SAMPLE_RATE)
+    signal = np.zeros(frames)
+    for frequency in (55.0, 440.0, 3520.0):
+        signal += np.sin(2 * np.pi * frequency * times)
+    signal *= 32767 / np.abs(signal).max()
+    return np.repeat(signal.astype(np.int16), num_channels)
+
+
+def noise_pcm(frames, num_channels):
+    """Interleaved int16 white noise"""
+    return np.random.randint(-32768, 32767, frames * num_channels).astype(np.int16)
+
+
+def sample_pcm(frames, num_channels):
+    """Interleaved int16 audio from the bundled sample song
+
+    :return: the audio, or None if the song can't be decoded here
+    :rtype: numpy.array
+    """
+    try:
+        import decoder
+        song = decoder.open(SAMPLE_SONG)
+        data = np.frombuffer(song.readframes(frames), dtype=np.int16)
+        song_channels = song.getnchannels()
+    except Exception as error:
+        logging.warning("Can't decode %s, skipping it: %s", SAMPLE_SONG, error)
+        return None
+
+    data = data[:len(data) - len(data) % song_channels].reshape(-1, song_channels)
+    if len(data) < frames:
+        data = np.resize(data, (frames, song_channels))
+    if song_channels != num_channels:
+        data = np.repeat(data[:, :1], num_channels, axis=1)
+    return data.ravel()
+
+
+SIGNALS = {'tones': tones_pcm, 'noise': noise_pcm, 'sample': sample_pcm}
+
+
+def time_per_call(function, calls, repeat):
+    """Best time of a single call, from repeat runs of calls calls"""
+    def run():
+        for _ in range(calls):
+            function()
+    elapsed, _ = best_time(run, repeat)
+    return elapsed / calls
+
+
+def benchmark_fft(pcm, chunk_size, num_bins, num_channels, chunks, repeat):
+    """Time the three ways of analyzing chunks of pcm
+
+    :return: seconds per chunk of each stage
+    :rtype: dict
+    """
+    limits = octave_limits(num_bins)
+    data = pcm[:chunk_size * num_channels * chunks]
+    frames = fft.frames_from_pcm(data, chunk_size, num_channels)
+    plan = fft.AnalysisPlan(chunk_size, SAMPLE_RATE, limits, num_bins, num_channels)
+
+    def one_shot():
+        fft.calculate_levels(frames[0], chunk_size, SAMPLE_RATE, limits, num_bins,
+                             num_channels)
+
+    results = dict()
+    results['fft'] = time_per_call(one_shot, max(chunks // 8, 1), repeat)
+    results['plan'] = time_per_call(lambda: [plan.calculate_levels(row) for row in frames],
+                                    1, repeat) / len(frames)
+    results['batch'] = time_per_call(lambda: plan.calculate_levels_batch(frames),
+                                     1, repeat) / len(frames)
+    return results
+
+
+def load_lights(num_bins, pin_mode):
+    """Import synchronized_lights set up for num_bins channels in pin_mode
+
+    hardware_controller reads its pins when imported, so it is reloaded
+    with the new configuration, and writes to the WiringPiStub.
+
+    :return: the synchronized_lights module, or None if it can't be imported
+    :rtype: module
+    """
+    try:
+        load_hardware(WiringPiStub(logging), range(num_bins), pin_mode)
+        import synchronized_lights
+    except ImportError as error:
+        logging.warning("Can't import synchronized_lights, skipping its stages: %s", error)
+        return None
+    return synchronized_lights
+
+
+def benchmark_lights(num_bins, calls, repeat):
+    """Time calculate_channel_frequency and update_lights for num_bins channels
+
+    :return: seconds per call of each stage (empty if they can't be run)
+    :rtype: dict
+    """
+    results = dict()
+    for pin_mode in ('onoff', 'pwm'):
+        lights = load_lights(num_bins, pin_mode)
+        if lights is None:
+            return results
+
+        matrix = np.random.uniform(8.0, 14.0, num_bins)
+        mean = [11.0 for _ in range(num_bins)]
+        std = [1.5 for _ in range(num_bins)]
+        results['update_lights_' + pin_mode] = \
+            time_per_call(lambda: lights.update_lights(matrix, mean, std, 0, 0.05), calls, repeat)
+
+        frame = lights.hc.frame_values(np.random.uniform(0.0, 1.0, num_bins))
+        results['write_frame_unchanged_' + pin_mode] = \
+            time_per_call(lambda: lights.hc.write_frame(frame), calls, repeat)
+
+        # forgetting the pin values makes every pin get written
+        def write_all():
+            lights.hc.force_refresh()
+            lights.hc.write_frame(frame)
+        results['write_frame_' + pin_mode] = time_per_call(write_all, calls, repeat)
+
+    results['calculate_channel_frequency'] = time_per_call(
+        lambda: lights.analysis.calculate_channel_frequency(20.0, 15000.0, 0, 0,
+                                                            num_channels=num_bins),
+        calls, repeat)
+    return results
+
+
+def git_commit():
+    """The current git commit of the lightshow, if known"""
+    try:
+        with open(os.devnull, 'w') as dev_null:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HOME_DIR,
+                                           stderr=dev_null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value):
+    """Comma separated ints argument"""
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunk-sizes', type=int_list, default=[512, 1024, 2048, 4096])
+    parser.add_argument('--channels', type=int_list, default=[8, 16, 32, 64, 128, 256],
+                        help='light channel counts')
+    parser.add_argument('--audio-channels', type=int_list, default=[1, 2],
+                        help='interleaved audio channel counts')
+    parser.add_argument('--signals', default='tones,noise,sample',
+                        help='input audio, any of ' + ','.join(sorted(SIGNALS)))
+    parser.add_argument('--chunks', type=int, default=64,
+                        help='number of chunks of audio analyzed per run')
+    parser.add_argument('--calls', type=int, default=200,
+                        help='number of update_lights calls per run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='file to write the JSON results to (default stdout)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = []
+
+    def record(stage, seconds, **configuration):
+        """Add a result and show progress"""
+        configuration.update(stage=stage, seconds=seconds)
+        results.append(configuration)
+        sys.stderr.write("%-30s %8.1f us  %s\n"
+                         % (stage, seconds * 1e6,
+                            ' '.join('%s=%s' % (key, configuration[key])
+                                     for key in sorted(configuration)
+                                     if key not in ('stage', 'seconds'))))
+
+    frames = max(args.chunk_sizes) * args.chunks
+    for signal in args.signals.split(','):
+        for num_channels in args.audio_channels:
+            pcm = SIGNALS[signal](frames, num_channels)
+            if pcm is None:
+                break
+            for chunk_size in args.chunk_sizes:
+                for num_bins in args.channels:
+                    timings = benchmark_fft(pcm, chunk_size, num_bins, num_channels,
+                                            args.chunks, args.repeat)
+                    for stage in sorted(timings):
+                        record(stage, timings[stage], signal=signal, chunk_size=chunk_size,
+                               channels=num_bins, audio_channels=num_channels)
+
+    for num_bins in args.channels:
+        timings = benchmark_lights(num_bins, args.calls, args.repeat)
+        for stage in sorted(timings):
+            record(stage, timings[stage], channels=num_bins)
+
+    report = {'machine': platform.machine(),
+              'platform': platform.platform(),
+              'python': platform.python_version(),
+              'numpy': np.__version__,
+              'commit': git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+
+if __name__ == "__main__":
+    main()
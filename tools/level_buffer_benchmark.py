@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Check that caching levels costs the same per chunk all through a long mix.
+
+Appends a row of levels per hop of a (default 60 minute) mix to a
+sync_cache.LevelBuffer, the way play_song does on a first play, and
+reports the cost per chunk in each tenth of the mix.  The same is done
+for the first minutes with np.vstack, as play_song used to, to show its
+cost growing as the song goes on.
+
+The script exits with an error if the last tenth of the mix costs more
+than MAX_SLOWDOWN times the first tenth per chunk.
+
+Sample usage:
+
+python level_buffer_benchmark.py --minutes=60 --channels=64
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+sys.path.insert(0, HOME_DIR + "/py")
+
+import sync_cache
+
+# Largest increase allowed in the per chunk cost from the first to the last tenth
+MAX_SLOWDOWN = 3.0
+
+
+def per_chunk_costs(append, rows, row, sections=10):
+    """Mean seconds per append in each section of rows appends"""
+    costs = []
+    bounds = np.linspace(0, rows, sections + 1).astype(int)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        began = time.time()
+        for _ in range(start, end):
+            append(row)
+        costs.append((time.time() - began) / max(end - start, 1))
+    return costs
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=60.0, help='length of the mix')
+    parser.add_argument('--vstack-minutes', type=float, default=3.0,
+                        help='length of mix to time np.vstack over (it is slow)')
+    parser.add_argument('--sample-rate', type=int, default=44100)
+    parser.add_argument('--hop-size', type=int, default=2048)
+    parser.add_argument('--channels', type=int, default=8, help='number of light channels')
+    parser.add_argument('--unsized', action='store_true',
+                        help="don't size the buffer up front (as when getnframes is unknown)")
+    args = parser.parse_args()
+
+    columns = args.channels + 2
+    row = np.random.uniform(8.0, 14.0, columns)
+    frames = int(args.minutes * 60 * args.sample_rate)
+    rows = sync_cache.expected_rows(frames, args.hop_size)
+
+    buffer = sync_cache.LevelBuffer(columns, capacity=0 if args.unsized else rows)
+    costs = per_chunk_costs(buffer.append, rows, row)
+
+    print "%d rows of %d columns (%.0f minutes, hop %d)" % \
+        (rows, columns, args.minutes, args.hop_size)
+    print "LevelBuffer us/chunk by tenth of the mix: " + \
+        ' '.join('%.2f' % (1e6 * cost) for cost in costs)
+
+    vstack_rows = sync_cache.expected_rows(int(args.vstack_minutes * 60 * args.sample_rate),
+                                           args.hop_size)
+    stacked = [np.empty((0, columns))]
+
+    def vstack(level_row):
+        """The old way, copying every row so far"""
+        stacked[0] = np.vstack([stacked[0], level_row])
+
+    vstack_costs = per_chunk_costs(vstack, vstack_rows, row)
+    print "np.vstack us/chunk by tenth of the first %.0f minutes: " % args.vstack_minutes + \
+        ' '.join('%.2f' % (1e6 * cost) for cost in vstack_costs)
+
+    slowdown = costs[-1] / costs[0]
+    print "LevelBuffer slowdown: %.2fx (limit %.1fx), np.vstack slowdown: %.2fx" % \
+        (slowdown, MAX_SLOWDOWN, vstack_costs[-1] / vstack_costs[0])
+    if not np.array_equal(buffer.levels, np.tile(row, (rows, 1))):
+        sys.exit("LevelBuffer levels don't match the appended rows")
+    if slowdown > MAX_SLOWDOWN:
+        sys.exit("appending levels gets slower through the mix")
+
+if __name__ == "__main__":
+    main()
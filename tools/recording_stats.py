@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Show the write rates and frame timing of a recording of the lights.
+
+Reads a recording made with output_backend = record (see
+output_backends.py) and prints the number of frames, the frames per
+second and the time between frames, and the pin changes per second, in
+total and for the busiest channel.
+
+With --compare, the frames of two recordings are compared, for
+regression testing a show on a machine without lights: repeated frames
+are dropped from both (how many times an unchanged frame gets written
+depends on timing) and the script exits with an error if what is left
+differs.
+
+Sample usage:
+
+python recording_stats.py ../logs/lights-20150101-200000.rec
+python recording_stats.py new.rec --compare=reference.rec
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+sys.path.insert(0, HOME_DIR + "/py")
+
+import output_backends
+
+
+def changes(values):
+    """Pin changes of each channel from each frame to the next"""
+    return np.diff(values.astype(np.int64), axis=0) != 0
+
+
+def distinct(values):
+    """The frames, without the ones repeating the frame before them"""
+    if not len(values):
+        return values
+    keep = np.ones(len(values), dtype=bool)
+    keep[1:] = changes(values).any(axis=1)
+    return values[keep]
+
+
+def print_stats(filename):
+    """Print the frame timing and write rates of a recording"""
+    header, records = output_backends.read_recording(filename)
+    times, values = records['time'], records['values']
+    print "%s: %d channels, pwm_range %d, %d frames" % \
+        (filename, len(header['gpio_pins']), header['pwm_range'], len(records))
+    if len(records) < 2:
+        return
+
+    duration = times[-1] - times[0]
+    intervals = np.diff(times) * 1000
+    changed = changes(values)
+    per_channel = changed.sum(axis=0)
+    busiest = int(per_channel.argmax())
+    print "%.1f seconds, %.1f frames/s" % (duration, (len(records) - 1) / duration)
+    print "time between frames: mean %.2f ms, median %.2f ms, 99%% %.2f ms, max %.2f ms" % \
+        (intervals.mean(), np.median(intervals), np.percentile(intervals, 99), intervals.max())
+    print "pin changes: %.1f/s, %.1f%% of the pin writes, busiest channel %d at %.1f/s" % \
+        (changed.sum() / duration, 100.0 * changed.mean(), busiest + 1,
+         per_channel[busiest] / duration)
+
+
+def compare(filename, reference):
+    """
+    Compare the distinct frames of two recordings
+
+    :return: do they match
+    :rtype: bool
+    """
+    values = distinct(output_backends.read_recording(filename)[1]['values'])
+    expected = distinct(output_backends.read_recording(reference)[1]['values'])
+    if values.shape == expected.shape and (values == expected).all():
+        print "%d distinct frames, the same as %s" % (len(values), reference)
+        return True
+
+    length = min(len(values), len(expected))
+    differ = np.flatnonzero((values[:length] != expected[:length]).any(axis=1))
+    first = differ[0] if len(differ) else length
+    print "%d distinct frames, %s has %d, they differ from frame %d" % \
+        (len(values), reference, len(expected), first)
+    return False
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('recording', help='the recording')
+    parser.add_argument('--compare', help='a reference recording to compare the frames with')
+    args = parser.parse_args()
+
+    print_stats(args.recording)
+    if args.compare and not compare(args.recording, args.compare):
+        sys.exit("the frames differ from the reference recording")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Check the duty cycles and cpu cost of the software pwm engines.
+
+Sets up hardware_controller with every channel in pwm mode on a
+recording wiringpi stand in, sets each channel to a different
+brightness, lets the pwm run for a while and measures the duty cycle of
+every pin from the recorded digitalWrites, along with the cpu time used
+and the context switches (thread wake ups) per second, for an
+increasing number of channels with each pwm_engine:
+
+single_thread - soft_pwm.SoftPwm, one thread for all the pins
+wiringpi      - wiringPi's softPwm, emulated here with one python thread
+                per pin, waking up twice a period as wiringPi's do
+
+The script exits with an error if a measured duty cycle of the
+single_thread engine is further than --tolerance from the duty set.
+
+The emulated wiringpi threads are python, so their cpu cost and wake
+ups only show how they grow with the number of pins, not what wiringPi's
+C threads cost on a Pi.
+
+Sample usage:
+
+python soft_pwm_check.py
+python soft_pwm_check.py --channels=8,16 --seconds=5 --frequency=200
+"""
+
+import argparse
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+
+HOME_DIR = os.getenv("SYNCHRONIZED_LIGHTS_HOME")
+if not HOME_DIR:
+    print("Need to setup SYNCHRONIZED_LIGHTS_HOME environment variable, "
+          "see readme")
+    sys.exit()
+sys.path.insert(0, HOME_DIR + "/py")
+
+from stub_hardware import load_hardware
+from wiring_pi_stub import WiringPiStub
+
+# wiringPi's soft pwm pulse width step in seconds
+SOFT_PWM_STEP = 100e-6
+
+
+class RecordingWiringPi(WiringPiStub):
+    """wiringpi stand in recording the time of every digitalWrite
+
+    softPwmCreate starts a thread pulsing the pin the way wiringPi's
+    softPwm does, through digitalWrite.
+    """
+
+    def __init__(self):
+        WiringPiStub.__init__(self, logging)
+        self.writes = list()
+        self._soft_pwm = dict()
+        self._threads = list()
+        self._stopping = threading.Event()
+
+    def digitalWrite(self, pin, value):
+        self.writes.append((time.time(), pin, value))
+
+    def softPwmCreate(self, pin, value, pwm_range):
+        self._soft_pwm[pin] = value
+        thread = threading.Thread(target=self._pulse, args=(pin, pwm_range))
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def softPwmWrite(self, pin, value):
+        self._soft_pwm[pin] = value
+
+    def stop(self):
+        """Stop the soft pwm threads"""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _pulse(self, pin, pwm_range):
+        while not self._stopping.is_set():
+            on = self._soft_pwm[pin]
+            if on:
+                self.digitalWrite(pin, 1)
+            time.sleep(on * SOFT_PWM_STEP)
+            if on < pwm_range:
+                self.digitalWrite(pin, 0)
+            time.sleep((pwm_range - on) * SOFT_PWM_STEP)
+
+
+def duty_cycles(writes, pins, start, end):
+    """Fraction of the time from start to end each pin was high"""
+    high = dict((pin, 0.0) for pin in pins)
+    level = dict((pin, 0) for pin in pins)
+    since = dict((pin, start) for pin in pins)
+    for when, pin, value in writes:
+        if when > end:
+            break
+        when = max(when, start)
+        if level[pin]:
+            high[pin] += when - since[pin]
+        level[pin] = value
+        since[pin] = when
+    for pin in pins:
+        if level[pin]:
+            high[pin] += end - since[pin]
+    return np.array([high[pin] / (end - start) for pin in pins])
+
+
+def cpu_usage():
+    """User and system cpu time, and context switches, of the process so far"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return np.array([usage.ru_utime + usage.ru_stime, usage.ru_nvcsw + usage.ru_nivcsw])
+
+
+def run(num_channels, engine, pwm_range, frequency, seconds):
+    """Pulse num_channels channels at different duties
+
+    :return: the duty set and measured of each channel, and the cpu time
+        and context switches per second
+    :rtype: tuple
+    """
+    hc = load_hardware(RecordingWiringPi(), range(num_channels), 'pwm', pwm_range=pwm_range,
+                       pwm_engine=engine, pwm_frequency=frequency, active_low_mode=False)
+    hc.initialize(exportpins=False)
+    brightness = (np.arange(num_channels) + 0.5) / num_channels
+    duty = hc.frame_values(brightness) / float(pwm_range)
+    hc.set_brightness(brightness)
+
+    # let the new duties take effect before measuring
+    time.sleep(0.1)
+    start, usage = time.time(), cpu_usage()
+    time.sleep(seconds)
+    end, usage = time.time(), cpu_usage() - usage
+
+    hc.clean_up(exportpins=False)
+    hc.wiringpi.stop()
+    measured = duty_cycles(hc.wiringpi.writes, hc._GPIO_PINS, start, end)
+    cpu, switches = usage / (end - start)
+    return duty, measured, cpu, switches
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', default='1,2,4,8,16,32',
+                        help='comma separated numbers of pwm channels')
+    parser.add_argument('--pwm-range', type=int, default=100)
+    parser.add_argument('--frequency', type=float, default=100.0,
+                        help='pwm frequency of the single_thread engine')
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help='seconds to measure each configuration')
+    parser.add_argument('--tolerance', type=float, default=0.03,
+                        help='largest difference from the duty set allowed')
+    args = parser.parse_args()
+
+    print "pwm_range %d, single_thread at %.0f Hz, wiringpi at %.0f Hz" % \
+        (args.pwm_range, args.frequency, 1.0 / (SOFT_PWM_STEP * args.pwm_range))
+    failed = False
+    for num_channels in [int(channels) for channels in args.channels.split(',')]:
+        for engine in ('single_thread', 'wiringpi'):
+            duty, measured, cpu, switches = run(num_channels, engine, args.pwm_range,
+                                                args.frequency, args.seconds)
+            error = np.abs(measured - duty).max()
+            over = engine == 'single_thread' and error > args.tolerance
+            print "%3d channels  %-13s  cpu %5.1f%%  %6.0f switches/s  duty error %.4f%s" % \
+                (num_channels, engine, cpu * 100, switches, error,
+                 '  OVER TOLERANCE' if over else '')
+            failed = failed or over
+
+    if failed:
+        sys.exit("measured duty cycles differ from the duty set by more than the tolerance")
+
+if __name__ == "__main__":
+    main()
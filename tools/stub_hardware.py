@@ -0,0 +1,43 @@
+#
+# Licensed under the BSD license.  See full license in LICENSE file.
+# http://www.lightshowpi.com/
+"""Set up hardware_controller on a wiringpi stand in, for the check tools.
+
+Used by expander_port_check.py, soft_pwm_check.py and
+hot_path_benchmark.py, which put HOME_DIR/py on the path before
+importing it.
+"""
+
+import configuration_manager as cm
+
+
+def load_hardware(wiringpi, pins, pin_modes, **settings):
+    """Import hardware_controller set up for the pins, writing to wiringpi
+
+    hardware_controller reads its configuration when imported, so it is
+    reloaded with the new one.
+
+    :param wiringpi: the wiringpi stand in the pins are written to
+    :type wiringpi: wiring_pi_stub.WiringPiStub
+
+    :param pins: wiringPi pin number of each channel
+    :type pins: list
+
+    :param pin_modes: the pin_modes setting
+    :type pin_modes: str
+
+    :param settings: any other [hardware] settings, by option name
+    :type settings: dict
+
+    :return: the hardware_controller module
+    :rtype: module
+    """
+    cm.CONFIG.set('hardware', 'gpio_pins', ','.join(str(pin) for pin in pins))
+    cm.CONFIG.set('hardware', 'pin_modes', pin_modes)
+    for option, value in settings.items():
+        cm.CONFIG.set('hardware', option, str(value))
+    cm._HARDWARE_CONFIG = dict()
+    import hardware_controller as hc
+    reload(hc)
+    hc.wiringpi = wiringpi
+    return hc